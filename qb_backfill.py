@@ -0,0 +1,336 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import time
+import socket
+import datetime
+import threading
+import importlib
+import fsspec
+import pyarrow as pa
+import pyarrow.parquet as pq
+from dateutil.relativedelta import relativedelta
+from qb_common import debug_message, error_message, load_credentials, S3_PREFIX
+from qb_query import get_session, fetch_entity
+from qb_change_index import row_hash, replace_index
+from qb_validate import gate, check_row_count
+from qb_ddl import measure_widths, table_spec
+from qb_load import swap_load
+from qb_s3 import spool, upload
+from qb_compact import compact_directory
+from qb_pipeline import flatten_records
+from qb_balances import rebuild_balances, CONTRIBUTIONS
+from qb_dimensions import refresh_dimensions, cached_records
+import qb_transactionlistbyvendordetail as report
+
+# Historical rebuilds split into TxnDate shards kept in a queue directory of
+# claim files: pending/ -> claimed/ -> done/ (or failed/ after MAX_ATTEMPTS).
+# The first shard has no lower date bound and the last no upper one, so the
+# swap at the end keeps records dated before HISTORY_START or after the plan.
+# A claim is an atomic rename, so any number of workers on any host that
+# shares QB_BACKFILL_DIR can pull from the same queue. Each shard writes one
+# Parquet part under the run's S3 prefix; the worker that completes the last
+# shard of an entity loads the whole prefix with one COPY and swap.
+#
+#   qb_backfill.py plan [ENTITY ...]   queue the shards of a new run
+#   qb_backfill.py work                claim and process shards until none are left
+#   qb_backfill.py requeue [ENTITY ...]  move failed shards back to pending
+#   qb_backfill.py status              count shards per state
+#
+# The change index is rebuilt on the host that finishes an entity, so
+# QB_CHANGE_INDEX should point at the same file the incremental runs use.
+BACKFILL_DIR = os.path.join(os.getenv("QB_BACKFILL_DIR", "/home/sameen/qb_scripts/backfill"), os.getenv("QB_BACKFILL_RUN", "default"))
+BACKFILL_PREFIX = f"{S3_PREFIX}/backfill/{os.getenv('QB_BACKFILL_RUN', 'default')}"
+HISTORY_START = datetime.date(2015, 1, 1)
+
+# Reports need both dates, so open vendor report windows run to these
+REPORT_FIRST_DATE = datetime.date(1900, 1, 1)
+REPORT_LAST_DATE = datetime.date(2099, 12, 31)
+STATES = ["pending", "claimed", "done", "failed", "loaded", "index"]
+
+# A claim whose heartbeat is older than this is given back to the queue
+CLAIM_SECONDS = int(os.getenv("QB_BACKFILL_CLAIM_SECONDS", "900"))
+HEARTBEAT_SECONDS = 60
+MAX_ATTEMPTS = 3
+
+ENTITIES = {
+    "JournalEntry": {"table": "finance.qb_journal_entry", "months": 1, "module": "qb_jounalentry",
+                     "sort_key": ('txn_date',), "dist_key": 'id'},
+    "Purchase": {"table": "finance.qb_purchase", "months": 1, "module": "qb_purchases",
+                 "sort_key": ('txn_date',), "dist_key": 'id'},
+    "TransactionListByVendor": {"table": "finance.qb_transactionlist_by_vendor", "months": 12, "module": None,
+                                "sort_key": ('date',), "dist_key": 'vendor_id'}
+}
+
+def state_dir(state):
+    return os.path.join(BACKFILL_DIR, state)
+
+def read_shard(path):
+    with open(path) as f:
+        return json.load(f)
+
+def write_shard(path, shard):
+    # Written beside the target and renamed over it, never seen half-written
+    temp_path = f"{path}.{socket.gethostname()}.{os.getpid()}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(shard, f)
+    os.replace(temp_path, path)
+
+def shard_windows(months, end_date):
+    # (start, end) pairs; None leaves the first start and the last end open
+    windows = []
+    window_start = HISTORY_START
+    while window_start <= end_date:
+        window_end = min(window_start + relativedelta(months=months) - datetime.timedelta(days=1), end_date)
+        windows.append([window_start, window_end])
+        window_start = window_end + datetime.timedelta(days=1)
+    windows[0][0] = None
+    windows[-1][1] = None
+    return [tuple(window) for window in windows]
+
+def window_name(day):
+    return "open" if day is None else f"{day:%Y%m%d}"
+
+def window_where(shard):
+    bounds = []
+    if shard["start"]:
+        bounds.append(f"TxnDate >= '{shard['start']}'")
+    if shard["end"]:
+        bounds.append(f"TxnDate <= '{shard['end']}'")
+    return " AND ".join(bounds) or None
+
+def window_label(shard):
+    return f"{shard['start'] or '...'}..{shard['end'] or '...'}"
+
+def plan(entities, end_date=None):
+    end_date = end_date or datetime.date.today()
+    for state in STATES:
+        os.makedirs(state_dir(state), exist_ok=True)
+    queued = 0
+    for entity in entities:
+        for window_start, window_end in shard_windows(ENTITIES[entity]["months"], end_date):
+            name = f"{entity}__{window_name(window_start)}__{window_name(window_end)}.json"
+            if any(os.path.exists(os.path.join(state_dir(state), name)) for state in STATES[:4]):
+                continue
+            write_shard(os.path.join(state_dir("pending"), name), {
+                "entity": entity, "start": window_start and window_start.isoformat(),
+                "end": window_end and window_end.isoformat(), "attempts": 0})
+            queued += 1
+    debug_message(f"{queued} shards queued in {BACKFILL_DIR}.")
+
+def claim():
+    for name in sorted(os.listdir(state_dir("pending"))):
+        if not name.endswith(".json"):
+            continue
+        claimed = os.path.join(state_dir("claimed"), name)
+        try:
+            os.rename(os.path.join(state_dir("pending"), name), claimed)
+        except FileNotFoundError:
+            continue
+        shard = read_shard(claimed)
+        shard["owner"] = f"{socket.gethostname()}:{os.getpid()}"
+        write_shard(claimed, shard)
+        return name, shard
+    return None, None
+
+def give_back(name, shard, error):
+    # Failed or abandoned shards go back to pending until MAX_ATTEMPTS
+    claimed = os.path.join(state_dir("claimed"), name)
+    shard["attempts"] = shard.get("attempts", 0) + 1
+    shard["error"] = error
+    shard.pop("owner", None)
+    write_shard(claimed, shard)
+    target = "failed" if shard["attempts"] >= MAX_ATTEMPTS else "pending"
+    try:
+        os.rename(claimed, os.path.join(state_dir(target), name))
+    except FileNotFoundError:
+        return
+    debug_message(f"Shard {name} returned to {target} after attempt {shard['attempts']}: {error}")
+
+def requeue_failed(entities):
+    # Failed shards start over with a fresh attempt count
+    requeued = 0
+    for entity in entities:
+        for name in entity_names(entity, "failed"):
+            path = os.path.join(state_dir("failed"), name)
+            shard = read_shard(path)
+            shard["attempts"] = 0
+            shard.pop("error", None)
+            write_shard(path, shard)
+            try:
+                os.rename(path, os.path.join(state_dir("pending"), name))
+            except FileNotFoundError:
+                continue
+            requeued += 1
+    debug_message(f"{requeued} failed shards returned to pending.")
+
+def requeue_stale():
+    now = time.time()
+    for name in os.listdir(state_dir("claimed")):
+        path = os.path.join(state_dir("claimed"), name)
+        try:
+            if not name.endswith(".json") or now - os.path.getmtime(path) < CLAIM_SECONDS:
+                continue
+            give_back(name, read_shard(path), "claim expired")
+        except FileNotFoundError:
+            continue
+
+def heartbeat(path, stop):
+    while not stop.wait(HEARTBEAT_SECONDS):
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+
+def part_url(entity, name):
+    return f"{BACKFILL_PREFIX}/{entity}/{name[:-len('.json')]}.parquet"
+
+def process_entity_shard(session, realm_id, name, shard):
+    # JournalEntry / Purchase: the incremental scripts' own transform and checks
+    entity = shard["entity"]
+    module = importlib.import_module(ENTITIES[entity]["module"])
+    counts = {}
+    records = fetch_entity(session, realm_id, entity, window_where(shard), counts=counts)
+    gate(f"{entity} {window_label(shard)}", check_row_count(entity, records, counts.get(entity)))
+    with open(os.path.join(state_dir("index"), name), "w") as f:
+        json.dump([(record["Id"], record.get("SyncToken"), row_hash(record)) for record in records], f)
+    if not records:
+        return 0, {}
+    df = flatten_records(ENTITIES[entity]["module"], records)
+    module.validate_frame(df)
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    with spool() as buffer:
+        pq.write_table(table, buffer, coerce_timestamps='us', allow_truncated_timestamps=True)
+        upload(buffer, part_url(entity, name))
+    return table.num_rows, measure_widths(table)
+
+def process_vendor_shard(session, realm_id, name, shard, vendors):
+    # One report window per vendor group, the shard's own dates
+    start = datetime.date.fromisoformat(shard["start"]) if shard["start"] else REPORT_FIRST_DATE
+    end = datetime.date.fromisoformat(shard["end"]) if shard["end"] else REPORT_LAST_DATE
+    vendor_ids_by_name = {vendor.get("DisplayName"): vendor["Id"] for vendor in vendors}
+    vendor_ids = [vendor["Id"] for vendor in vendors]
+    shards = [(vendor_ids[offset:offset + report.VENDORS_PER_SHARD], start, end)
+              for offset in range(0, len(vendor_ids), report.VENDORS_PER_SHARD)]
+    with spool() as sink:
+        rows, widths = report.extract_to_parquet(session, realm_id, shards, vendor_ids_by_name, sink)
+        if rows:
+            upload(sink, part_url(shard["entity"], name))
+    return rows, widths
+
+def entity_names(entity, state):
+    return [name for name in os.listdir(state_dir(state)) if name.startswith(f"{entity}__") and name.endswith(".json")]
+
+def finish(entity):
+    # Runs once per entity: only when every shard is done, and only in the
+    # worker that wins the loaded/<entity> marker
+    if any(entity_names(entity, state) for state in ("pending", "claimed", "failed")) or not entity_names(entity, "done"):
+        return False
+    marker = os.path.join(state_dir("loaded"), entity)
+    try:
+        os.close(os.open(marker, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+    except FileExistsError:
+        return False
+
+    spec = ENTITIES[entity]
+    done = [read_shard(os.path.join(state_dir("done"), name)) for name in entity_names(entity, "done")]
+    widths = {}
+    for shard in done:
+        for column, width in shard.get("widths", {}).items():
+            widths[column] = max(widths.get(column, 0), width)
+    with_rows = [shard for shard in done if shard.get("rows")]
+    if not with_rows:
+        debug_message(f"{entity}: backfill produced no rows; nothing to load.")
+        return True
+    with fsspec.open(with_rows[0]["part_url"], "rb") as f:
+        schema = pq.read_schema(f)
+
+    # One part per shard is compacted into a few large sorted files first; the
+    # COPY then reads the compacted files through the directory's manifest
+    manifest_url = compact_directory(f"{BACKFILL_PREFIX}/{entity}", sort_by=spec["sort_key"])
+    debug_message(f"{entity}: loading {sum(shard['rows'] for shard in with_rows)} rows from {len(with_rows)} parts.")
+    loaded = swap_load(spec["table"], manifest_url,
+                       spec=table_spec(schema, widths, sort_key=spec["sort_key"], dist_key=spec["dist_key"]))
+    if not loaded:
+        os.remove(marker)
+        return False
+    if spec["module"] is not None:
+        rows = []
+        for name in entity_names(entity, "done"):
+            with open(os.path.join(state_dir("index"), name)) as f:
+                rows.extend(json.load(f))
+        replace_index(entity, rows)
+        debug_message(f"{entity}: change index rebuilt with {len(rows)} records.")
+    if entity in CONTRIBUTIONS:
+        # The line table was replaced wholesale, so its balances are reseeded from it
+        rebuild_balances(entity)
+    return True
+
+def work():
+    credentials = load_credentials()
+    if credentials is None:
+        raise SystemExit(1)
+    realm_id = credentials["realm_id"]
+    session = get_session(credentials)
+    vendors = None
+
+    while True:
+        requeue_stale()
+        name, shard = claim()
+        if name is None:
+            break
+        claimed = os.path.join(state_dir("claimed"), name)
+        stop = threading.Event()
+        threading.Thread(target=heartbeat, args=(claimed, stop), daemon=True).start()
+        started = time.monotonic()
+        try:
+            if shard["entity"] == "TransactionListByVendor":
+                if vendors is None:
+                    refresh_dimensions(session, realm_id, ["Vendor"])
+                    vendors = cached_records("Vendor")
+                rows, widths = process_vendor_shard(session, realm_id, name, shard, vendors)
+            else:
+                rows, widths = process_entity_shard(session, realm_id, name, shard)
+        except Exception as e:
+            stop.set()
+            error_message(f"Shard {name} failed: {str(e)}")
+            give_back(name, shard, str(e))
+            continue
+        stop.set()
+        shard.update({"rows": rows, "widths": widths, "part_url": part_url(shard["entity"], name) if rows else None})
+        write_shard(claimed, shard)
+        os.rename(claimed, os.path.join(state_dir("done"), name))
+        debug_message(f"Shard {name}: {rows} rows in {time.monotonic() - started:.1f}s.")
+        finish(shard["entity"])
+
+    for entity in ENTITIES:
+        finish(entity)
+
+def status():
+    for entity in ENTITIES:
+        counts = {state: len(entity_names(entity, state)) for state in STATES[:4]}
+        if any(counts.values()):
+            loaded = os.path.exists(os.path.join(state_dir("loaded"), entity))
+            print(f"{entity}: " + ", ".join(f"{count} {state}" for state, count in counts.items()) + (" (loaded)" if loaded else ""))
+
+if __name__ == "__main__":
+    command = sys.argv[1] if len(sys.argv) > 1 else "status"
+    if command in ("plan", "requeue"):
+        entities = sys.argv[2:] or list(ENTITIES)
+        unknown = [entity for entity in entities if entity not in ENTITIES]
+        if unknown:
+            error_message(f"Unknown entities: {', '.join(unknown)}")
+            raise SystemExit(1)
+        if command == "plan":
+            plan(entities)
+        else:
+            requeue_failed(entities)
+    elif command == "work":
+        work()
+    elif command == "status":
+        status()
+    else:
+        error_message(f"Unknown command: {command}. Use plan, work, requeue or status.")
+        raise SystemExit(1)
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+
+import os
+import sqlite3
+import threading
+import pandas as pd
+from qb_common import debug_message, error_message, get_redshift_connection, S3_PREFIX
+from qb_ddl import frame_spec
+from qb_s3 import write_parquet, swap_if_changed
+
+# Account x month (x class x department) debit, credit and net totals for
+# trial balances and P&L drill-downs. Every JournalEntry and Purchase keeps
+# its contribution in a local SQLite store; a run replaces the contributions
+# of the records it saw change and drops those of deleted records, and the
+# small summary table is rebuilt from the store. This only happens after the
+# run's line load succeeded, so the summary never gets ahead of the lines.
+# If the balance step itself fails, the entity's contributions are dropped
+# and the next run reseeds them from the loaded lines.
+STORE_PATH = os.getenv("QB_BALANCE_STORE", "/home/sameen/qb_scripts/qb_balances.sqlite")
+BALANCE_TABLE = 'finance.qb_account_month_balance'
+
+# Line columns read from Redshift to seed an entity the store has not seen yet
+SEED_COLUMNS = {
+    "JournalEntry": ("finance.qb_journal_entry", ['id', 'txn_date', 'line_amount', 'line_posting_type', 'line_account_value',
+                                                  'line_class_value', 'line_department_value']),
+    "Purchase": ("finance.qb_purchase", ['id', 'txn_date', 'credit', 'line_amount', 'line_account_value', 'account_ref_value'])
+}
+
+CONTRIBUTION_COLUMNS = ['id', 'account', 'month', 'class_id', 'department_id', 'debit', 'credit']
+
+LOAD_LOCK = threading.Lock()
+
+def open_store(path=None):
+    conn = sqlite3.connect(path or STORE_PATH, timeout=30)
+    conn.execute("""CREATE TABLE IF NOT EXISTS contribution (
+        entity TEXT NOT NULL,
+        id TEXT NOT NULL,
+        account INTEGER,
+        month TEXT NOT NULL,
+        class_id INTEGER,
+        department_id INTEGER,
+        debit REAL NOT NULL,
+        credit REAL NOT NULL
+    );""")
+    conn.execute("CREATE INDEX IF NOT EXISTS contribution_record ON contribution (entity, id);")
+    return conn
+
+def month_start(txn_date):
+    return pd.to_datetime(txn_date, errors='coerce').dt.to_period('M').dt.to_timestamp().dt.strftime('%Y-%m-%d')
+
+def summarize(df):
+    # One row per record, account, month, class and department
+    df = df.dropna(subset=['month'])
+    keys = ['id', 'account', 'month', 'class_id', 'department_id']
+    return df.groupby(keys, dropna=False, sort=False)[['debit', 'credit']].sum().reset_index()[CONTRIBUTION_COLUMNS]
+
+def journal_contributions(df):
+    amount = pd.to_numeric(df['line_amount'], errors='coerce').fillna(0).astype('float64')
+    posting = df['line_posting_type'].astype('string').str.lower()
+    return summarize(pd.DataFrame({
+        'id': df['id'].astype('int64').astype(str),
+        'account': pd.to_numeric(df['line_account_value'], errors='coerce').astype('Int64'),
+        'month': month_start(df['txn_date']),
+        'class_id': pd.to_numeric(df['line_class_value'], errors='coerce').astype('Int64'),
+        'department_id': pd.to_numeric(df['line_department_value'], errors='coerce').astype('Int64'),
+        'debit': amount.where(posting == 'debit', 0.0),
+        'credit': amount.where(posting == 'credit', 0.0)
+    }))
+
+def purchase_contributions(df):
+    # Lines debit their expense account and the payment account is credited
+    # with the same amount; a refund (Credit = true) reverses both sides.
+    # Purchase lines carry no class or department.
+    amount = pd.to_numeric(df['line_amount'], errors='coerce').fillna(0).astype('float64')
+    refund = df['credit'].astype('string').str.lower().eq('true').fillna(False)
+    ids = pd.to_numeric(df['id'], errors='coerce').astype('int64').astype(str)
+    months = month_start(df['txn_date'])
+    sides = []
+    for account_column, debit in (('line_account_value', amount.where(~refund, 0.0)), ('account_ref_value', amount.where(refund, 0.0))):
+        sides.append(pd.DataFrame({
+            'id': ids,
+            'account': pd.to_numeric(df[account_column], errors='coerce').astype('Int64'),
+            'month': months,
+            'class_id': pd.array([pd.NA] * len(df), dtype='Int64'),
+            'department_id': pd.array([pd.NA] * len(df), dtype='Int64'),
+            'debit': debit,
+            'credit': amount - debit
+        }))
+    return summarize(pd.concat(sides, ignore_index=True))
+
+CONTRIBUTIONS = {
+    "JournalEntry": journal_contributions,
+    "Purchase": purchase_contributions
+}
+
+def seed_frame(entity):
+    table, columns = SEED_COLUMNS[entity]
+    conn = get_redshift_connection()
+    try:
+        cur = conn.cursor()
+        cur.execute(f"SELECT {', '.join(columns)} FROM {table};")
+        df = pd.DataFrame(cur.fetchall(), columns=columns)
+        cur.close()
+        conn.commit()
+    finally:
+        conn.close()
+    return df
+
+def store_rows(entity, contributions):
+    return [(entity, row.id, None if pd.isna(row.account) else int(row.account), row.month,
+             None if pd.isna(row.class_id) else int(row.class_id),
+             None if pd.isna(row.department_id) else int(row.department_id),
+             float(row.debit), float(row.credit))
+            for row in contributions.itertuples(index=False)]
+
+def update_balances(entity, df, changes):
+    # df holds the flattened lines of the changed records (None when only
+    # deletions came through)
+    conn = open_store()
+    try:
+        seeded = conn.execute("SELECT 1 FROM contribution WHERE entity = ? LIMIT 1;", (entity,)).fetchone() is not None
+        seed = None
+        if changes.get("reseed") or (not seeded and not changes["full_refresh"]):
+            # Contributions start from what is already loaded, then this run's changes replace theirs
+            debug_message(f"Seeding {entity} balances from {SEED_COLUMNS[entity][0]}.")
+            seed = CONTRIBUTIONS[entity](seed_frame(entity))
+        affected = [pending[1] for pending in changes["pending"]] + [str(record_id) for record_id in changes["deleted_ids"]]
+        with conn:
+            if changes["full_refresh"] or changes.get("reseed"):
+                conn.execute("DELETE FROM contribution WHERE entity = ?;", (entity,))
+            if seed is not None:
+                conn.executemany("INSERT INTO contribution VALUES (?, ?, ?, ?, ?, ?, ?, ?);", store_rows(entity, seed))
+            conn.executemany("DELETE FROM contribution WHERE entity = ? AND id = ?;", [(entity, record_id) for record_id in affected])
+            if df is not None and len(df):
+                conn.executemany("INSERT INTO contribution VALUES (?, ?, ?, ?, ?, ?, ?, ?);", store_rows(entity, CONTRIBUTIONS[entity](df)))
+    finally:
+        conn.close()
+
+def balance_frame():
+    conn = open_store()
+    try:
+        df = pd.read_sql_query("""SELECT entity AS source, account, month, class_id, department_id,
+                                         SUM(debit) AS debit, SUM(credit) AS credit
+                                  FROM contribution
+                                  GROUP BY entity, account, month, class_id, department_id
+                                  ORDER BY month, account;""", conn)
+    finally:
+        conn.close()
+    df['net'] = df['debit'] - df['credit']
+    df['month'] = pd.to_datetime(df['month']).dt.date
+    df = df.astype({'source': 'string', 'account': 'Int64', 'class_id': 'Int64', 'department_id': 'Int64',
+                    'debit': 'float64', 'credit': 'float64', 'net': 'float64'})
+    return df
+
+def clear_balances(entity):
+    conn = open_store()
+    try:
+        with conn:
+            conn.execute("DELETE FROM contribution WHERE entity = ?;", (entity,))
+    finally:
+        conn.close()
+
+def load_balances():
+    # Loads of JournalEntry and Purchase may run concurrently; the summary is
+    # rebuilt and swapped by one of them at a time
+    with LOAD_LOCK:
+        df = balance_frame()
+        s3_url = f'{S3_PREFIX}/qb_account_month_balance.parquet'
+        digest = write_parquet(df, s3_url)
+        debug_message(f"{len(df)} balance rows saved to Parquet file: {s3_url}")
+        return swap_if_changed(BALANCE_TABLE, s3_url, digest, frame_spec(df, sort_key=('month', 'account'), diststyle='ALL'), df)
+
+def refresh_balances(entity, df, changes):
+    # The summary is derived data: a failure here is reported but never fails
+    # the entity's load; the store is dropped so the next run reseeds it
+    try:
+        update_balances(entity, df, changes)
+        if not load_balances():
+            raise RuntimeError(f"{BALANCE_TABLE} did not load")
+    except Exception as e:
+        error_message(f"An error occurred while updating account balances from {entity}: {str(e)}")
+        try:
+            clear_balances(entity)
+        except Exception as e:
+            error_message(f"Could not clear the {entity} balance store: {str(e)}")
+
+def load_with_balances(entity, df, changes, load, *args, **kwargs):
+    # Submitted in place of the line load: the balances follow only a load
+    # that succeeded
+    loaded = load(*args, **kwargs)
+    if loaded and (df is not None or changes["deleted_ids"]):
+        refresh_balances(entity, df, changes)
+    return loaded
+
+def rebuild_balances(entity):
+    # After the line table was replaced wholesale (backfill): reseed the
+    # entity's contributions from the loaded lines and reload the summary
+    refresh_balances(entity, None, {"full_refresh": False, "pending": [], "deleted_ids": [], "reseed": True})
@@ -1,16 +1,24 @@
 #!/usr/bin/env python
 
-import requests
 import base64
 import pandas as pd
 import os
-from dotenv import load_dotenv
 import pyarrow as pa
 import pyarrow.parquet as pq
 import boto3
 from io import BytesIO
 import psycopg2
+from qb_common import load_credentials, to_int
+from qb_query import get_session, fetch_entity, run_batch
+from qb_change_index import detect_changes, load_changes
+from qb_coordinator import submit_load
 import datetime
+from qb_dimensions import slim_names
+from qb_ddl import frame_spec
+from qb_validate import gate, check_row_count
+
+# Bill ids per IN (...) lookup; a lone statement goes out as a GET query string
+IDS_PER_QUERY = 100
 
 def debug_message(message):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -39,47 +47,55 @@ def execute_sql(sql_query):
     except Exception as e:
         error_message(f"An error occurred while executing SQL query: {str(e)}")
 
-def fetch_quickbooks_data():
+def fetch_bill_dates(session, realm_id, bill_ids):
+    # Only the dates of the bills referenced by changed payments are needed,
+    # so ask for just those fields, packed into batch calls. The id lists are
+    # kept short enough for the query to stay well inside URL length limits.
+    bill_ids = sorted(set(bill_ids))
+    statements = []
+    for offset in range(0, len(bill_ids), IDS_PER_QUERY):
+        id_list = ", ".join(f"'{bill_id}'" for bill_id in bill_ids[offset:offset + IDS_PER_QUERY])
+        statements.append(f"SELECT Id, TxnDate, DueDate FROM Bill WHERE Id IN ({id_list}) MAXRESULTS {IDS_PER_QUERY}")
+    bill_dates = {}
+    for response in run_batch(session, realm_id, statements):
+        for bill in response.get("Bill", []):
+            bill_dates[bill["Id"]] = (bill.get("TxnDate"), bill.get("DueDate"))
+    return bill_dates
+
+def build_bill_payment_links(session, realm_id, payments):
+    # Each payment line settles part of one or more bills through LinkedTxn;
+    # the line amount is the amount applied to that bill
+    rows = []
+    for payment in payments:
+        for line in payment.get("Line", []):
+            for linked_txn in line.get("LinkedTxn", []):
+                if linked_txn.get("TxnType") != "Bill":
+                    continue
+                rows.append({
+                    "bill_id": linked_txn.get("TxnId"),
+                    "payment_id": to_int(payment.get("Id")),
+                    "amount": line.get("Amount"),
+                    "pay_type": payment.get("PayType"),
+                    "payment_txn_date": payment.get("TxnDate")
+                })
+    bill_dates = fetch_bill_dates(session, realm_id, [row["bill_id"] for row in rows])
+    for row in rows:
+        row["bill_txn_date"], row["bill_due_date"] = bill_dates.get(row["bill_id"], (None, None))
+        row["bill_id"] = to_int(row["bill_id"])
+
+    df_links = pd.DataFrame(rows, columns=["bill_id", "payment_id", "amount", "pay_type", "payment_txn_date", "bill_txn_date", "bill_due_date"])
+    df_links = df_links.astype({"bill_id": "Int32", "payment_id": "Int32", "amount": "float64", "pay_type": "string"})
+    for col in ["payment_txn_date", "bill_txn_date", "bill_due_date"]:
+        df_links[col] = pd.to_datetime(df_links[col], errors='coerce').dt.date
+    return df_links
+
+def fetch_quickbooks_data(session, realm_id):
     try:
         debug_message("Fetching QuickBooks data...")
-        load_dotenv("/home/sameen/qb_scripts/.env")
-        load_dotenv("/home/sameen/qb_scripts/.env_access")
-        client_id = os.getenv("CLIENT_ID")
-        client_secret = os.getenv("CLIENT_SECRET")
-        refresh_token = os.getenv("REFRESH_TOKEN")
-        realm_id = os.getenv("REALM_ID")
-        access_token = os.getenv("CURR_AUTH_TOKEN")
-        if not all([client_id, client_secret, refresh_token, realm_id, access_token]):
-            error_message("Missing required credentials. Check .env and .env_access files.")
-            return None
-        
-        url_query = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-        select_statement = "select * from billpayment"
-        headers_query = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "text/plain",
-            "Accept": "application/json",
-        }
-        all_data = []  
-        has_more = True
-        start_position = 1
-        while has_more:
-            params_query = {
-                "query": f"{select_statement} STARTPOSITION {start_position}",
-            }
-            response_query = requests.get(url_query, headers=headers_query, params=params_query)
-            if response_query.status_code != 200:
-                error_message(f"Failed to fetch data from QuickBooks API. Status code: {response_query.status_code}")
-                return None
-            response_json = response_query.json()
-            query_response = response_json.get("QueryResponse", {})
-            billpayments = query_response.get("BillPayment", [])
-            all_data.extend(billpayments)  
-            start_position += len(billpayments)
-            has_more = query_response.get("maxResults") == 100
-        df_selected = pd.json_normalize(all_data)  
-        print("Columns after normalization:", df_selected.columns)
-        return df_selected
+        counts = {}
+        all_data = fetch_entity(session, realm_id, "BillPayment", counts=counts)
+        gate("BillPayment extract", check_row_count("BillPayment", all_data, counts.get("BillPayment")))
+        return detect_changes("BillPayment", all_data)
     except Exception as e:
         error_message(f"An error occurred while fetching QuickBooks data: {str(e)}")
         return None
@@ -87,15 +103,26 @@ def fetch_quickbooks_data():
 
 try:
     debug_message("Script started.")
-    
-    df_selected = fetch_quickbooks_data()
-    if df_selected is not None:
+
+    credentials = load_credentials()
+    if credentials is None:
+        raise SystemExit(1)
+    session = get_session(credentials)
+
+    changes = fetch_quickbooks_data(session, credentials["realm_id"])
+    link_table = {"table": "finance.qb_bill_payment_link", "s3_url": None, "key": "payment_id", "spec": None}
+    if changes is not None and not changes["records"]:
+        # Nothing was added or edited since the last run; only deletions (if any) are applied
+        submit_load('finance.qb_billpayment', load_changes, 'finance.qb_billpayment', None, changes, children=[link_table])
+    elif changes is not None:
         debug_message("QuickBooks data fetched.")
-        
+        df_selected = pd.json_normalize(changes["records"])
+        print("Columns after normalization:", df_selected.columns)
+
         selected_columns = ['PayType', 'TotalAmt', 'Id', 'TxnDate', 'VendorRef.value','VendorRef.name', 'CheckPayment.BankAccountRef.value','CheckPayment.BankAccountRef.name',
                     'DocNumber', 'CreditCardPayment.CCAccountRef.value', 'CreditCardPayment.CCAccountRef.name']
 
-        df_selected = df_selected[selected_columns]
+        df_selected = df_selected.reindex(columns=selected_columns)
 
         df_selected.columns = ["".join(["_" + char.lower() if char.isupper() else char for char in col]).lstrip("_") for col in selected_columns]
 
@@ -127,49 +154,28 @@ try:
         }
         print("Columns before type casting:", df_selected.columns)
         df_selected = df_selected.astype(data_types)
+
+        # Type dates here so the Parquet file matches the final table column for column
+        df_selected['txn_date'] = pd.to_datetime(df_selected['txn_date'], errors='coerce')
         
 
+        # Names live in the qb_dim_* tables; optionally keep only the ids in the fact rows
+        df_selected = slim_names(df_selected, ['vendor_ref_name', 'check_payment_bank_account_ref_name', 'credit_card_payment_cc_account_ref_name'])
+
         s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_billpayment.parquet'
         # Write DataFrame to Parquet with the specified column names
-        df_selected.to_parquet(s3_url)
-
-        # Define SQL statements
-        sql_statements = [
-            """CREATE TABLE finance.temp_qb_billpayment (
-                pay_type VARCHAR(255),
-                total_amt DOUBLE PRECISION,
-                id INT,
-                txn_date VARCHAR(255),
-                vendor_ref_value INT,
-                vendor_ref_name VARCHAR(255),
-                check_payment_bank_account_ref_value INT,
-                check_payment_bank_account_ref_name VARCHAR(255),
-                doc_number VARCHAR(255),
-                credit_card_payment_cc_account_ref_value INT,
-                credit_card_payment_cc_account_ref_name VARCHAR(255)
-            );""",
-            f"COPY finance.temp_qb_billpayment FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-            "TRUNCATE TABLE finance.qb_billpayment;",
-            """INSERT INTO finance.qb_billpayment
-               SELECT 
-                   pay_type,
-                   total_amt,
-                   id,
-                   TO_TIMESTAMP(txn_date, 'YYYY-MM-DD HH24:MI:SS'),
-                   vendor_ref_value,
-                   vendor_ref_name,
-                   check_payment_bank_account_ref_value,
-                   check_payment_bank_account_ref_name,
-                   doc_number,
-                   credit_card_payment_cc_account_ref_value,
-                   credit_card_payment_cc_account_ref_name
-               FROM finance.temp_qb_billpayment;""",
-            "DROP TABLE finance.temp_qb_billpayment;"
-        ]
-
-        # Execute SQL statements
-        for sql_statement in sql_statements:
-            execute_sql(sql_statement)
+        df_selected.to_parquet(s3_url, index=False, engine='pyarrow', coerce_timestamps='us', allow_truncated_timestamps=True)
+
+        # Precomputed bill <-> payment links so AP queries no longer parse linked_txn JSON
+        df_links = build_bill_payment_links(session, credentials["realm_id"], changes["records"])
+        link_table["s3_url"] = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_bill_payment_link.parquet'
+        df_links.to_parquet(link_table["s3_url"], index=False, engine='pyarrow', coerce_timestamps='us', allow_truncated_timestamps=True)
+        link_table["spec"] = frame_spec(df_links, sort_key=('bill_txn_date',), dist_key='bill_id')
+        link_table["frame"] = df_links
+
+        # Only new and edited payments are written, then merged into finance.qb_billpayment and its link table
+        submit_load('finance.qb_billpayment', load_changes, 'finance.qb_billpayment', s3_url, changes, children=[link_table],
+                     spec=frame_spec(df_selected, sort_key=('txn_date',)), frame=df_selected)
             
     else:
         error_message("Failed to fetch QuickBooks data. Exiting script.")
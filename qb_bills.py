@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 
-import requests
 import json
 import pandas as pd
 import os
-from dotenv import load_dotenv
 import psycopg2
+from qb_common import load_credentials, get_path, to_int
+from qb_query import get_session, fetch_entity, QuickBooksAPIError
+from qb_change_index import detect_changes, load_changes
+from qb_coordinator import submit_load
+from qb_dimensions import slim_names
+from qb_ddl import frame_spec
+from qb_validate import gate, check_row_count, ValidationError
 
 def execute_sql(sql_query):
     try:
@@ -26,149 +31,173 @@ def execute_sql(sql_query):
     except Exception as e:
         print(f"An error occurred while executing SQL query: {str(e)}")
 
-# Load environment variables
-load_dotenv("/home/sameen/qb_scripts/.env")
-load_dotenv("/home/sameen/qb_scripts/.env_access")
-
-# Get environment variables
-client_id = os.getenv("CLIENT_ID")
-client_secret = os.getenv("CLIENT_SECRET")
-refresh_token = os.getenv("REFRESH_TOKEN")
-realm_id = os.getenv("REALM_ID")
-access_token = os.getenv("CURR_AUTH_TOKEN")
-
-url_report = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-
-# Define the query to fetch all bills
-query = {
-    "query": "SELECT * FROM Bill"
-}
-
-# Ensure your access token is valid
-headers_report = {
-    "Authorization": f"Bearer {access_token}",
-    "Content-Type": "application/text",
-    "Accept": "application/json"
-}
+def flatten_bill_lines(bills):
+    # One typed row per bill line, keyed by (bill_id, line_id); the detail
+    # block is either account based or item based
+    rows = []
+    for bill in bills:
+        for line in bill.get("Line", []):
+            detail_type = line.get("DetailType")
+            detail = line.get(detail_type, {}) if detail_type else {}
+            rows.append({
+                "bill_id": to_int(bill.get("Id")),
+                "line_id": to_int(line.get("Id")),
+                "line_num": to_int(line.get("LineNum")),
+                "txn_date": bill.get("TxnDate"),
+                "description": line.get("Description"),
+                "amount": line.get("Amount"),
+                "detail_type": detail_type,
+                "account_ref_value": to_int(get_path(detail, "AccountRef.value")),
+                "account_ref_name": get_path(detail, "AccountRef.name"),
+                "item_ref_value": to_int(get_path(detail, "ItemRef.value")),
+                "item_ref_name": get_path(detail, "ItemRef.name"),
+                "qty": detail.get("Qty"),
+                "unit_price": detail.get("UnitPrice"),
+                "billable_status": detail.get("BillableStatus"),
+                "tax_code_ref_value": get_path(detail, "TaxCodeRef.value"),
+                "customer_ref_value": to_int(get_path(detail, "CustomerRef.value")),
+                "class_ref_value": to_int(get_path(detail, "ClassRef.value"))
+            })
+    df_lines = pd.DataFrame(rows, columns=[
+        "bill_id", "line_id", "line_num", "txn_date", "description", "amount", "detail_type",
+        "account_ref_value", "account_ref_name", "item_ref_value", "item_ref_name", "qty", "unit_price",
+        "billable_status", "tax_code_ref_value", "customer_ref_value", "class_ref_value"
+    ])
+    df_lines = df_lines.astype({
+        "bill_id": "Int32",
+        "line_id": "Int32",
+        "line_num": "Int32",
+        "description": "string",
+        "amount": "float64",
+        "detail_type": "string",
+        "account_ref_value": "Int32",
+        "account_ref_name": "string",
+        "item_ref_value": "Int32",
+        "item_ref_name": "string",
+        "qty": "float64",
+        "unit_price": "float64",
+        "billable_status": "string",
+        "tax_code_ref_value": "string",
+        "customer_ref_value": "Int32",
+        "class_ref_value": "Int32"
+    })
+    df_lines["txn_date"] = pd.to_datetime(df_lines["txn_date"], errors='coerce').dt.date
+    return df_lines
+
+def build_frame(bills):
+    # Bills -> one typed row per bill, named like the finance.qb_bills columns
+    df = pd.json_normalize(bills)
+
+    # Print the DataFrame columns before filtering
+    print("Original DataFrame columns:")
+    print(df.columns)
+
+    # Define the columns you want to keep (updated to match the actual column names)
+    selected_columns = [
+        "DueDate",
+        "Balance",
+        "Id",
+        "SyncToken",
+        "DocNumber",
+        "TxnDate",
+        "PrivateNote",
+        "Line",
+        "VendorRef.value",
+        "VendorRef.name",
+        "APAccountRef.value",
+        "APAccountRef.name",
+        "LinkedTxn"
+    ]
+    
+    # Filter the DataFrame to include only the selected columns
+    df = df.reindex(columns=selected_columns)
+
+    # Rename columns to snake_case
+    df.columns = ["".join(["_" + char.lower() if char.isupper() else char for char in col]).lstrip("_") for col in df.columns]
+    df.columns = df.columns.str.replace('.', '_')
+    df.columns = df.columns.str.replace('__', '_')
+    df.rename(columns={'a_p_account_ref_value': 'ap_account_ref_value', 'a_p_account_ref_name': 'ap_account_ref_name'}, inplace=True)
+
+    # Print the filtered DataFrame columns
+    print("Filtered DataFrame columns:")
+    print(df.columns)
+
+    # Define data types
+    data_types = {
+        "due_date": "string",
+        "balance": "float64",
+        "id": "int32",
+        "sync_token": "int32",
+        "doc_number": "string",
+        "txn_date": "string",
+        "private_note": "string",
+        "line": "string",
+        "vendor_ref_value": "string",
+        "vendor_ref_name": "string",
+        "ap_account_ref_value": "string",
+        "ap_account_ref_name": "string",
+        "linked_txn": "string"
+    }
+
+    # Apply data types where applicable
+    for col, dtype in data_types.items():
+        if col in df.columns:
+            df[col] = df[col].astype(dtype)
+
+    # Type dates here so the Parquet file matches the final table column for column
+    for col in ["due_date", "txn_date"]:
+        df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
+
+    # Check data types before saving to Parquet
+    print("DataFrame data types:")
+    print(df.dtypes)
+
+    # Names live in the qb_dim_* tables; optionally keep only the ids in the fact rows
+    return slim_names(df, ['vendor_ref_name', 'ap_account_ref_name'])
+
+if __name__ == "__main__":
+    # Load environment variables
+    credentials = load_credentials()
+    if credentials is None:
+        raise SystemExit(1)
+
+    # Fetch every bill page; deletions can only be detected against a complete extract
+    session = get_session(credentials)
+    try:
+        counts = {}
+        all_bills = fetch_entity(session, credentials["realm_id"], "Bill", counts=counts)
+        gate("Bill extract", check_row_count("Bill", all_bills, counts.get("Bill")))
+    except (QuickBooksAPIError, ValidationError) as e:
+        print(f"Error: {str(e)}")
+        raise SystemExit(1)
 
-# Make the request
-response_report = requests.post(url_report, headers=headers_report, data=query["query"])
+    changes = detect_changes("Bill", all_bills)
 
-if response_report.status_code == 200:
-    report_data = response_report.json()
-    
-    # Extract relevant data from the response
-    bills = report_data.get("QueryResponse", {}).get("Bill", [])
-    
+    # Only new and edited bills go through the transform and load
+    bills = changes["records"]
     if bills:
-        # Normalize the JSON to flatten nested data and convert to DataFrame
-        df = pd.json_normalize(bills)
-
-        # Print the DataFrame columns before filtering
-        print("Original DataFrame columns:")
-        print(df.columns)
-
-        # Define the columns you want to keep (updated to match the actual column names)
-        selected_columns = [
-            "DueDate",
-            "Balance",
-            "Id",
-            "SyncToken",
-            "DocNumber",
-            "TxnDate",
-            "PrivateNote",
-            "Line",
-            "VendorRef.value",
-            "VendorRef.name",
-            "APAccountRef.value",
-            "APAccountRef.name",
-            "LinkedTxn"
-        ]
-        
-        # Filter the DataFrame to include only the selected columns
-        df = df[selected_columns]
-
-        # Rename columns to snake_case
-        df.columns = ["".join(["_" + char.lower() if char.isupper() else char for char in col]).lstrip("_") for col in df.columns]
-
-        # Print the filtered DataFrame columns
-        print("Filtered DataFrame columns:")
-        print(df.columns)
-
-        # Define data types
-        data_types = {
-            "due_date": "string",
-            "balance": "float64",
-            "id": "int32",
-            "sync_token": "int32",
-            "doc_number": "string",
-            "txn_date": "string",
-            "private_note": "string",
-            "line": "string",
-            "vendor_ref_value": "string",
-            "vendor_ref_name": "string",
-            "ap_account_ref_value": "string",
-            "ap_account_ref_name": "string",
-            "linked_txn": "string"
-        }
-
-        # Apply data types where applicable
-        for col, dtype in data_types.items():
-            if col in df.columns:
-                df[col] = df[col].astype(dtype)
-
-        # Check data types before saving to Parquet
-        print("DataFrame data types:")
-        print(df.dtypes)
+        df = build_frame(bills)
 
         # Save DataFrame to Parquet file
         s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_bills.parquet'
         print(f"Saving DataFrame to Parquet file at {s3_url}")
         df.to_parquet(s3_url, index=False, engine='pyarrow')
 
-        # Define SQL statements
-        sql_statements = [
-            """CREATE TABLE finance.temp_qb_bills(
-                due_date VARCHAR(255),          
-                balance DOUBLE PRECISION,         
-                id INT,            
-                sync_token INT,            
-                doc_number VARCHAR(50),   
-                txn_date VARCHAR(255),           
-                private_note VARCHAR(255),   
-                line VARCHAR(MAX),   
-                vendor_ref_value VARCHAR(255),            
-                vendor_ref_name VARCHAR(255),   
-                ap_account_ref_value VARCHAR(255),            
-                ap_account_ref_name VARCHAR(255),   
-                linked_txn VARCHAR(MAX)
-            );""",
-            f"COPY finance.temp_qb_bills FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-            "TRUNCATE TABLE finance.qb_bills;",
-            """INSERT INTO finance.qb_bills
-                SELECT 
-                    TO_DATE(due_date, 'YYYY-MM-DD') AS due_date,
-                    balance,
-                    id, 
-                    sync_token,
-                    doc_number,
-                    TO_DATE(txn_date, 'YYYY-MM-DD') AS txn_date,
-                    private_note,
-                    line,
-                    vendor_ref_value,
-                    vendor_ref_name,
-                    ap_account_ref_value,
-                    ap_account_ref_name,
-                    linked_txn
-                FROM finance.temp_qb_bills;""",
-            """DROP TABLE finance.temp_qb_bills;"""
-        ]
-
-        for sql in sql_statements:
-            print(f"Executing SQL statement: {sql}")
-            execute_sql(sql)
+        # Bill lines go to their own typed child table instead of being parsed from JSON in Redshift
+        df_lines = flatten_bill_lines(bills)
+        df_lines = slim_names(df_lines, ['account_ref_name', 'item_ref_name'])
+        lines_s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_bill_line.parquet'
+        print(f"Saving {len(df_lines)} bill lines to Parquet file at {lines_s3_url}")
+        df_lines.to_parquet(lines_s3_url, index=False, engine='pyarrow')
+
+        # Only new and edited bills are written, then merged into finance.qb_bills and finance.qb_bill_line
+        submit_load('finance.qb_bills', load_changes, 'finance.qb_bills', s3_url, changes, spec=frame_spec(df, sort_key=('txn_date',), dist_key='id'), frame=df, children=[
+            {"table": "finance.qb_bill_line", "s3_url": lines_s3_url, "key": "bill_id",
+             "spec": frame_spec(df_lines, sort_key=('txn_date',), dist_key='bill_id'), "frame": df_lines}
+        ])
 
     else:
-        print("No bills data found in the response.")
-else:
-    print(f"Error: {response_report.status_code}, {response_report.text}")
+        print("No new or changed bills since the last run.")
+        submit_load('finance.qb_bills', load_changes, 'finance.qb_bills', None, changes, children=[
+            {"table": "finance.qb_bill_line", "s3_url": None, "key": "bill_id", "spec": None}
+        ])
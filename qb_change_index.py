@@ -0,0 +1,154 @@
+#!/usr/bin/env python
+
+import os
+import json
+import sqlite3
+import hashlib
+from qb_common import debug_message
+from qb_load import swap_load, merge_load
+from qb_sinks import mirror
+
+# Local index of Id -> (SyncToken, row hash) per entity from the last successful load
+INDEX_PATH = os.getenv("QB_CHANGE_INDEX", "/home/sameen/qb_scripts/qb_change_index.sqlite")
+
+def open_index(path=None):
+    conn = sqlite3.connect(path or INDEX_PATH)
+    conn.execute("""CREATE TABLE IF NOT EXISTS row_index (
+        entity TEXT NOT NULL,
+        id TEXT NOT NULL,
+        sync_token TEXT,
+        row_hash TEXT NOT NULL,
+        PRIMARY KEY (entity, id)
+    ) WITHOUT ROWID;""")
+    return conn
+
+def row_hash(record):
+    payload = json.dumps(record, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+def full_refresh_requested():
+    return os.getenv("QB_FULL_REFRESH", "").lower() in ("1", "true", "yes")
+
+def start_changes(entity):
+    # Records can be fed in pages with track_changes; finish_changes works out
+    # the deletions once the whole extract has been seen
+    conn = open_index()
+    try:
+        if full_refresh_requested():
+            known = {}
+        else:
+            known = {row[0]: (row[1], row[2]) for row in conn.execute(
+                "SELECT id, sync_token, row_hash FROM row_index WHERE entity = ?;", (entity,))}
+    finally:
+        conn.close()
+
+    return {
+        "entity": entity,
+        "full_refresh": not known,
+        "records": [],
+        "inserted": 0,
+        "updated": 0,
+        "unchanged": 0,
+        "deleted_ids": [],
+        "pending": [],
+        "known": known,
+        "seen": set()
+    }
+
+def track_changes(changes, records):
+    # Returns the records of this page that are new or edited
+    changed = []
+    for record in records:
+        record_id = str(record.get("Id"))
+        sync_token = record.get("SyncToken")
+        digest = row_hash(record)
+        changes["seen"].add(record_id)
+        previous = changes["known"].get(record_id)
+        if previous == (sync_token, digest):
+            changes["unchanged"] += 1
+            continue
+        changes["inserted" if previous is None else "updated"] += 1
+        changed.append(record)
+        changes["pending"].append((changes["entity"], record_id, sync_token, digest))
+    changes["records"].extend(changed)
+    return changed
+
+def finish_changes(changes):
+    known, seen = changes.pop("known"), changes.pop("seen")
+    changes["deleted_ids"] = [record_id for record_id in known if record_id not in seen]
+    debug_message(
+        f"{changes['entity']}: {changes['inserted']} inserted, {changes['updated']} updated, "
+        f"{changes['unchanged']} unchanged, {len(changes['deleted_ids'])} deleted."
+    )
+    return changes
+
+def detect_changes(entity, records):
+    # Split a full extract into inserted, updated and unchanged records. Ids
+    # known to the index but missing from the extract were deleted upstream.
+    changes = start_changes(entity)
+    track_changes(changes, records)
+    return finish_changes(changes)
+
+def commit_changes(changes):
+    # Only called once the load has succeeded, so a failed run is retried in full
+    conn = open_index()
+    try:
+        with conn:
+            if changes["full_refresh"]:
+                conn.execute("DELETE FROM row_index WHERE entity = ?;", (changes["entity"],))
+            conn.executemany(
+                "INSERT OR REPLACE INTO row_index (entity, id, sync_token, row_hash) VALUES (?, ?, ?, ?);",
+                changes["pending"])
+            conn.executemany(
+                "DELETE FROM row_index WHERE entity = ? AND id = ?;",
+                [(changes["entity"], record_id) for record_id in changes["deleted_ids"]])
+    finally:
+        conn.close()
+
+def replace_index(entity, rows):
+    # rows are (id, sync_token, row_hash); used after a backfill has loaded the
+    # whole entity, so the next incremental run starts from what was loaded
+    conn = open_index()
+    try:
+        with conn:
+            conn.execute("DELETE FROM row_index WHERE entity = ?;", (entity,))
+            conn.executemany(
+                "INSERT OR REPLACE INTO row_index (entity, id, sync_token, row_hash) VALUES (?, ?, ?, ?);",
+                [(entity, str(record_id), sync_token, digest) for record_id, sync_token, digest in rows])
+    finally:
+        conn.close()
+
+def load_changes(table, s3_url, changes, key='id', children=(), spec=None, frame=None):
+    # children are line tables of the same records, given as dicts with
+    # 'table', 's3_url', 'key' (the parent id column), 'spec' (see qb_ddl) and
+    # 'frame' (the data written to s3_url, for the local mirrors); the index
+    # only moves forward once the parent and every child loaded
+    if s3_url is None and not changes["deleted_ids"]:
+        debug_message(f"No changes for {table}; skipping load.")
+        return True
+    deleted_ids = [int(record_id) for record_id in changes["deleted_ids"]]
+    # Child rows of an edited parent are cleared by parent id as well, since an
+    # edit can remove every line and leave nothing in staging to match on
+    changed_ids = deleted_ids + [int(pending[1]) for pending in changes["pending"]]
+    targets = [{"table": table, "s3_url": s3_url, "key": key, "spec": spec, "frame": frame, "parent": True}] + list(children)
+    loaded = True
+    for target in targets:
+        if changes["full_refresh"]:
+            loaded = swap_load(target["table"], target["s3_url"], spec=target["spec"]) and loaded
+        else:
+            loaded = merge_load(target["table"], target["s3_url"], key=target["key"],
+                                deleted_ids=deleted_ids if target.get("parent") else changed_ids,
+                                spec=target["spec"]) and loaded
+    if loaded:
+        # Local mirrors follow the same replace / merge as Redshift; a target
+        # whose data was not handed over is left alone rather than half-merged
+        for target in targets:
+            if target["s3_url"] is not None and target.get("frame") is None:
+                continue
+            if changes["full_refresh"]:
+                mirror('replace', target["table"], target["frame"])
+            else:
+                mirror('merge', target["table"], target.get("frame"), key=target["key"],
+                       deleted_ids=deleted_ids if target.get("parent") else changed_ids)
+        commit_changes(changes)
+    return loaded
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+import datetime
+from array import array
+import numpy as np
+import pyarrow as pa
+
+# Append-only typed column buffers for report rows. Strings are interned into a
+# per-column dictionary and stored as int32 codes, numbers go into flat
+# array('d') / array('q') buffers, so a million-row report costs a few bytes per
+# cell instead of a Python object per cell. Dates are kept as interned strings
+# and each distinct value is parsed once when the table is built.
+STRING = 'string'
+FLOAT = 'float'
+INT = 'int'
+DATE = 'date'
+
+ARROW_TYPES = {
+    STRING: pa.dictionary(pa.int32(), pa.string()),
+    FLOAT: pa.float64(),
+    INT: pa.int32(),
+    DATE: pa.date32()
+}
+
+def parse_float(value):
+    try:
+        return float(value) if value not in (None, '') else float('nan')
+    except (TypeError, ValueError):
+        return float('nan')
+
+def parse_int(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+def parse_date(value):
+    try:
+        return datetime.date.fromisoformat(value[:10]) if value else None
+    except (TypeError, ValueError):
+        return None
+
+class ColumnBuffers:
+
+    def __init__(self, columns):
+        # columns: list of (name, kind) in output order
+        self.columns = list(columns)
+        self.length = 0
+        self.codes = {}
+        self.dictionaries = {}
+        self.values = {}
+        self.valid = {}
+        for name, kind in self.columns:
+            if kind in (STRING, DATE):
+                self.codes[name] = array('i')
+                self.dictionaries[name] = {}
+            elif kind == FLOAT:
+                self.values[name] = array('d')
+            elif kind == INT:
+                self.values[name] = array('q')
+                self.valid[name] = bytearray()
+            else:
+                raise ValueError(f"Unknown column kind: {kind}")
+
+    def __len__(self):
+        return self.length
+
+    def schema(self):
+        return pa.schema([(name, ARROW_TYPES[kind]) for name, kind in self.columns])
+
+    def append(self, row):
+        # row: values in column order, as they come out of the report
+        for (name, kind), value in zip(self.columns, row):
+            if kind in (STRING, DATE):
+                if value is None:
+                    self.codes[name].append(-1)
+                else:
+                    dictionary = self.dictionaries[name]
+                    code = dictionary.get(value)
+                    if code is None:
+                        code = dictionary[value] = len(dictionary)
+                    self.codes[name].append(code)
+            elif kind == FLOAT:
+                self.values[name].append(parse_float(value))
+            else:
+                parsed = parse_int(value)
+                self.values[name].append(parsed or 0)
+                self.valid[name].append(parsed is not None)
+        self.length += 1
+
+    def column_array(self, name, kind):
+        if kind in (STRING, DATE):
+            codes = np.frombuffer(self.codes[name], dtype=np.int32)
+            indices = pa.array(codes, mask=codes < 0)
+            dictionary = list(self.dictionaries[name])
+            if kind == STRING:
+                return pa.DictionaryArray.from_arrays(indices, pa.array(dictionary, pa.string()))
+            # Each distinct date string is parsed once, then gathered by code
+            parsed = pa.array([parse_date(value) for value in dictionary], pa.date32())
+            return parsed.take(indices)
+        values = np.frombuffer(self.values[name], dtype=np.float64 if kind == FLOAT else np.int64)
+        if kind == FLOAT:
+            return pa.array(values, mask=np.isnan(values))
+        valid = np.frombuffer(bytes(self.valid[name]), dtype=np.bool_)
+        return pa.array(values, mask=~valid).cast(pa.int32())
+
+    def to_arrow(self):
+        return pa.Table.from_arrays(
+            [self.column_array(name, kind) for name, kind in self.columns],
+            schema=self.schema())
+
+    def to_pandas(self):
+        return self.to_arrow().to_pandas()
@@ -0,0 +1,129 @@
+#!/usr/bin/env python
+
+import os
+import datetime
+import threading
+import psycopg2
+import psycopg2.extensions
+from dotenv import load_dotenv
+
+ENV_FILES = [
+    "/home/sameen/qb_scripts/.env",
+    "/home/sameen/qb_scripts/.env_access"
+]
+
+S3_PREFIX = 's3://datalake-medusadistribution/datalake/to_redshift/qb'
+
+# Set by the daemon: Redshift connections and one HTTP session per token are
+# kept open and handed out again instead of being opened for every load.
+# Idle connections are pooled, so concurrent loads each get their own.
+WARM = {"enabled": False, "idle": [], "lock": threading.Lock()}
+
+def debug_message(message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[{timestamp}] {message}")
+
+def error_message(message):
+    timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    print(f"[ERROR] [{timestamp}] {message}")
+
+def get_path(record, path, default=None):
+    # Walk a dotted path such as 'AccountBasedExpenseLineDetail.AccountRef.value'
+    value = record
+    for key in path.split('.'):
+        if not isinstance(value, dict) or key not in value:
+            return default
+        value = value[key]
+    return value
+
+def to_int(value):
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        return None
+
+def load_credentials():
+    for env_file in ENV_FILES:
+        load_dotenv(env_file)
+    credentials = {
+        "client_id": os.getenv("CLIENT_ID"),
+        "client_secret": os.getenv("CLIENT_SECRET"),
+        "refresh_token": os.getenv("REFRESH_TOKEN"),
+        "realm_id": os.getenv("REALM_ID"),
+        "access_token": os.getenv("CURR_AUTH_TOKEN")
+    }
+    if not all(credentials.values()):
+        error_message("Missing required credentials. Check .env and .env_access files.")
+        return None
+    return credentials
+
+def reload_environment():
+    # A long-running process has to pick up tokens rewritten since it started
+    for env_file in ENV_FILES:
+        load_dotenv(env_file, override=True)
+
+class WarmConnection(psycopg2.extensions.connection):
+    # close() only resets the connection and returns it to the idle pool
+    def close(self):
+        if self.closed:
+            return
+        if not self.autocommit:
+            self.rollback()
+        self.autocommit = False
+        with WARM["lock"]:
+            WARM["idle"].append(self)
+
+    def shutdown(self):
+        super().close()
+
+def keep_connections_warm():
+    WARM["enabled"] = True
+
+def close_warm_connections():
+    with WARM["lock"]:
+        idle, WARM["idle"] = WARM["idle"], []
+    for conn in idle:
+        conn.shutdown()
+
+def connect_redshift(connection_factory=None):
+    return psycopg2.connect(
+        dbname=os.getenv("REDSHIFT_DB"),
+        user=os.getenv("REDSHIFT_USER"),
+        password=os.getenv("REDSHIFT_PASSWORD"),
+        host=os.getenv("REDSHIFT_HOST"),
+        port=os.getenv("REDSHIFT_PORT"),
+        connection_factory=connection_factory
+    )
+
+def get_redshift_connection():
+    if not WARM["enabled"]:
+        return connect_redshift()
+    while True:
+        with WARM["lock"]:
+            conn = WARM["idle"].pop() if WARM["idle"] else None
+        if conn is None:
+            return connect_redshift(WarmConnection)
+        if conn.closed:
+            continue
+        try:
+            cur = conn.cursor()
+            cur.execute("SELECT 1;")
+            cur.close()
+            conn.rollback()
+            return conn
+        except psycopg2.Error:
+            debug_message("Warm Redshift connection was dropped; reconnecting.")
+            conn.shutdown()
+
+def execute_sql(sql_query):
+    try:
+        debug_message("Executing SQL query...")
+        conn = get_redshift_connection()
+        cur = conn.cursor()
+        cur.execute(sql_query)
+        conn.commit()
+        cur.close()
+        conn.close()
+        debug_message("SQL query executed successfully.")
+    except Exception as e:
+        error_message(f"An error occurred while executing SQL query: {str(e)}")
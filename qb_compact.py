@@ -0,0 +1,178 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import json
+import datetime
+import fsspec
+from fsspec.implementations.local import LocalFileSystem
+import pyarrow as pa
+import pyarrow.parquet as pq
+from qb_common import debug_message, error_message
+from qb_load import MANIFEST_NAME
+from qb_sinks import PARQUET_DIR
+from qb_spectrum import ROWS_PER_ROW_GROUP
+
+# Compaction of directories that collect many small Parquet files: local
+# mirror tables (one part per append), backfill prefixes (one part per shard)
+# or any partition directory given on the command line. Small files are
+# merged into files of about TARGET_FILE_MB with rows sorted by the given
+# columns, so row-group statistics stay useful. Merged files are written
+# under _compacting/, which Spectrum and the directory readers skip, and a
+# plan listing them and the files they supersede is saved beside them. Only
+# then are the superseded files deleted and the merged ones moved in, so a
+# reader listing the directory never sees a row twice. A run that dies after
+# saving the plan is finished by the next one; without a plan the staged
+# files are thrown away. The COPY manifest (one PUT, or an atomic rename
+# locally) lists the staged files until they are in place.
+#
+#   qb_compact.py                                 compact every mirror table
+#   qb_compact.py [--sort col,col] DIR [DIR ...]   compact the given directories
+TARGET_FILE_MB = int(os.getenv("QB_COMPACT_TARGET_MB", "128"))
+
+# Files at or above this share of the target are already big enough
+SMALL_FILE_SHARE = 0.5
+
+STAGING_NAME = "_compacting"
+PLAN_NAME = "plan.json"
+
+def parquet_files(fs, path):
+    files = fs.ls(path, detail=True)
+    return sorted((f for f in files if f["type"] == "file" and f["name"].endswith(".parquet")), key=lambda f: f["name"])
+
+def file_url(fs, path):
+    return fs.unstrip_protocol(path)
+
+def write_json(fs, path, data):
+    if isinstance(fs, LocalFileSystem):
+        temp_path = f"{path}.{os.getpid()}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(data, f)
+        os.replace(temp_path, path)
+    else:
+        # A single PUT: readers see either the old object or the new one
+        with fs.open(path, "w") as f:
+            json.dump(data, f)
+
+def write_manifest(fs, path, files):
+    # Redshift needs content_length for every Parquet entry of a manifest
+    manifest = {"entries": [{"url": file_url(fs, f["name"]), "mandatory": True,
+                             "meta": {"content_length": f["size"]}} for f in files]}
+    manifest_path = f"{path}/{MANIFEST_NAME}"
+    write_json(fs, manifest_path, manifest)
+    return file_url(fs, manifest_path)
+
+def move_in(fs, staged, target):
+    # Copied, not moved, so the manifest's staged entries stay readable until it is rewritten
+    if isinstance(fs, LocalFileSystem):
+        temp_path = f"{target}.{os.getpid()}.tmp"
+        fs.copy(staged, temp_path)
+        os.replace(temp_path, target)
+    else:
+        fs.copy(staged, target)
+
+def finish_staged(fs, path):
+    # Completes a compaction whose plan was saved; returns the manifest URL,
+    # or None when there was no plan (any half-written staging is dropped)
+    staging = f"{path}/{STAGING_NAME}"
+    plan_path = f"{staging}/{PLAN_NAME}"
+    if not fs.exists(plan_path):
+        if fs.exists(staging):
+            fs.rm(staging, recursive=True)
+        return None
+    with fs.open(plan_path, "r") as f:
+        plan = json.load(f)
+    superseded = [name for name in plan["superseded"] if fs.exists(name)]
+    if superseded:
+        fs.rm(superseded)
+    for staged in plan["staged"]:
+        target = f"{path}/{staged.rsplit('/', 1)[1]}"
+        if not fs.exists(target):
+            move_in(fs, staged, target)
+    manifest_url = write_manifest(fs, path, parquet_files(fs, path))
+    fs.rm(staging, recursive=True)
+    return manifest_url
+
+def small_file_groups(files, target_bytes):
+    # Consecutive small files, grouped until a group reaches the target size
+    groups = []
+    group = []
+    size = 0
+    for f in files:
+        if f["size"] >= target_bytes * SMALL_FILE_SHARE:
+            continue
+        group.append(f)
+        size += f["size"]
+        if size >= target_bytes:
+            groups.append(group)
+            group, size = [], 0
+    if group:
+        groups.append(group)
+    return [group for group in groups if len(group) > 1]
+
+def compact_group(fs, staging, group, sort_by, index):
+    tables = []
+    for f in group:
+        with fs.open(f["name"], "rb") as source:
+            tables.append(pq.read_table(source))
+    table = pa.concat_tables(tables, promote_options='default')
+    sort_by = [column for column in sort_by if column in table.column_names]
+    if sort_by:
+        table = table.sort_by([(column, "ascending") for column in sort_by])
+    stamp = datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%S")
+    target = f"{staging}/compacted-{stamp}-{index:05d}.parquet"
+    with fs.open(target, "wb") as sink:
+        pq.write_table(table, sink, row_group_size=ROWS_PER_ROW_GROUP, write_statistics=True)
+    return target, table.num_rows
+
+def compact_directory(url, sort_by=(), target_mb=None):
+    # Returns the URL of the directory's manifest, or None when it has no Parquet files
+    fs, path = fsspec.core.url_to_fs(url)
+    path = path.rstrip('/')
+    target_bytes = (target_mb or TARGET_FILE_MB) * 1024 * 1024
+    if finish_staged(fs, path):
+        debug_message(f"{file_url(fs, path)}: finished an interrupted compaction.")
+    files = parquet_files(fs, path)
+    if not files:
+        return None
+
+    groups = small_file_groups(files, target_bytes)
+    if not groups:
+        return write_manifest(fs, path, files)
+    staging = f"{path}/{STAGING_NAME}"
+    fs.makedirs(staging, exist_ok=True)
+    superseded = []
+    staged = []
+    for index, group in enumerate(groups):
+        target, rows = compact_group(fs, staging, group, sort_by, index)
+        superseded.extend(f["name"] for f in group)
+        staged.append(target)
+        debug_message(f"{len(group)} files ({sum(f['size'] for f in group)} bytes, {rows} rows) compacted into {file_url(fs, target)}")
+
+    write_json(fs, f"{staging}/{PLAN_NAME}", {"superseded": superseded, "staged": staged})
+    live = [f for f in parquet_files(fs, path) if f["name"] not in set(superseded)]
+    write_manifest(fs, path, live + [fs.info(target) for target in staged])
+    manifest_url = finish_staged(fs, path)
+    debug_message(f"{file_url(fs, path)}: {len(files)} files -> {len(live) + len(staged)} files.")
+    return manifest_url
+
+def mirror_directories(root=None):
+    root = root or PARQUET_DIR
+    if not os.path.isdir(root):
+        return []
+    return sorted(os.path.join(root, schema, name)
+                  for schema in os.listdir(root) if os.path.isdir(os.path.join(root, schema))
+                  for name in os.listdir(os.path.join(root, schema))
+                  if os.path.isdir(os.path.join(root, schema, name)) and not name.endswith((".incoming", ".retired")))
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    sort_by = ()
+    if args[:1] == ["--sort"] and len(args) > 1:
+        sort_by = tuple(column.strip() for column in args[1].split(",") if column.strip())
+        args = args[2:]
+    for directory in args or mirror_directories():
+        try:
+            compact_directory(directory, sort_by)
+        except Exception as e:
+            error_message(f"An error occurred while compacting {directory}: {str(e)}")
@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from qb_common import debug_message, error_message
+
+# Finished extracts hand their load (COPY, merge or swap plus whatever follows
+# it) to the coordinator, which runs the loads of all entities concurrently up
+# to the number of WLM slots the pipeline may use. Without a running
+# coordinator, as under cron, submit_load simply runs the load in place.
+WLM_SLOTS = int(os.getenv("QB_WLM_SLOTS", "3"))
+
+COORDINATOR = {"executor": None, "jobs": []}
+
+def start_coordinator(slots=None):
+    if COORDINATOR["executor"] is None:
+        slots = slots or WLM_SLOTS
+        COORDINATOR["executor"] = ThreadPoolExecutor(max_workers=slots, thread_name_prefix="qb-load")
+        debug_message(f"Load coordinator started with {slots} slots.")
+
+def run_load(name, load, args, kwargs):
+    started = time.monotonic()
+    result = load(*args, **kwargs)
+    debug_message(f"Load {name} finished in {time.monotonic() - started:.1f}s.")
+    return result
+
+def submit_load(name, load, *args, **kwargs):
+    executor = COORDINATOR["executor"]
+    if executor is None:
+        return load(*args, **kwargs)
+    debug_message(f"Load {name} queued.")
+    future = executor.submit(run_load, name, load, args, kwargs)
+    COORDINATOR["jobs"].append((name, future))
+    return future
+
+def wait_for_loads():
+    # Blocks until every queued load is done; returns {name: result}
+    jobs, COORDINATOR["jobs"] = COORDINATOR["jobs"], []
+    results = {}
+    for name, future in jobs:
+        try:
+            results[name] = future.result()
+        except Exception as e:
+            error_message(f"Load {name} failed: {str(e)}")
+            results[name] = False
+    return results
+
+def stop_coordinator():
+    results = wait_for_loads()
+    if COORDINATOR["executor"] is not None:
+        COORDINATOR["executor"].shutdown()
+        COORDINATOR["executor"] = None
+    return results
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import runpy
+import signal
+import datetime
+
+# Heavy modules are imported once here and stay loaded for every job run
+import pandas
+import pyarrow
+import pyarrow.parquet
+import psycopg2
+import requests
+import fsspec
+
+try:
+    import boto3
+except ImportError:
+    boto3 = None
+
+from qb_common import debug_message, error_message, reload_environment, keep_connections_warm, close_warm_connections
+from qb_coordinator import start_coordinator, wait_for_loads, stop_coordinator
+from qb_maintenance import run_maintenance
+
+SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# Job name -> (script, default interval). QB_DAEMON_INTERVALS overrides the
+# intervals, e.g. "JournalEntry=15m,ProfitAndLoss=1d,Deposit=off"
+JOBS = {
+    "Dimensions": ("qb_dimensions.py", "1h"),
+    "JournalEntry": ("qb_jounalentry.py", "15m"),
+    "Purchase": ("qb_purchases.py", "15m"),
+    "Bill": ("qb_bills.py", "15m"),
+    "BillPayment": ("qb_billpayments.py", "15m"),
+    "Deposit": ("qb_deposit.py", "15m"),
+    "TransactionList": ("qb_transactionlist.py", "1d"),
+    "TransactionListByVendor": ("qb_transactionlistbyvendordetail.py", "1d"),
+    "ProfitAndLoss": ("qb_profit&loss.py", "1d")
+}
+
+UNITS = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+
+# Longest sleep between schedule checks, so a stop signal is noticed promptly
+POLL_SECONDS = 30
+
+def parse_interval(value):
+    # "900", "15m", "6h" or "1d"; "off" or 0 disables the job
+    value = value.strip().lower()
+    if value in ("", "off", "0"):
+        return None
+    if value[-1] in UNITS:
+        return int(value[:-1]) * UNITS[value[-1]]
+    return int(value)
+
+def job_intervals():
+    intervals = {name: parse_interval(default) for name, (_, default) in JOBS.items()}
+    for item in os.getenv("QB_DAEMON_INTERVALS", "").split(","):
+        if "=" not in item:
+            continue
+        name, value = item.split("=", 1)
+        name = name.strip()
+        if name not in JOBS:
+            error_message(f"Unknown job in QB_DAEMON_INTERVALS: {name}")
+            continue
+        intervals[name] = parse_interval(value)
+    return {name: interval for name, interval in intervals.items() if interval}
+
+def run_job(name):
+    # Scripts run in-process as if launched directly, reusing the loaded modules
+    # and the warm connections; a failing job never stops the daemon
+    script = JOBS[name][0]
+    started = time.monotonic()
+    debug_message(f"Job {name} started.")
+    try:
+        reload_environment()
+        runpy.run_path(os.path.join(SCRIPT_DIR, script), run_name="__main__")
+    except SystemExit as e:
+        if e.code not in (None, 0):
+            error_message(f"Job {name} exited with status {e.code}.")
+    except Exception as e:
+        error_message(f"Job {name} failed: {str(e)}")
+    debug_message(f"Job {name} finished in {time.monotonic() - started:.1f}s.")
+
+def run_once():
+    # Every enabled job once, extracts one after another and loads overlapping
+    # through the coordinator, then exit; suitable for a single cron entry
+    keep_connections_warm()
+    start_coordinator()
+    for name in job_intervals():
+        run_job(name)
+    stop_coordinator()
+    run_maintenance()
+    close_warm_connections()
+
+def run_forever():
+    intervals = job_intervals()
+    if not intervals:
+        error_message("No jobs enabled. Check QB_DAEMON_INTERVALS.")
+        return
+    for name, interval in intervals.items():
+        debug_message(f"Scheduling {name} every {datetime.timedelta(seconds=interval)}.")
+
+    stopping = []
+    def stop(signum, frame):
+        debug_message("Stop requested; finishing the current job.")
+        stopping.append(signum)
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+
+    keep_connections_warm()
+    start_coordinator()
+    # Every job runs once at startup, then on its own interval. The loads of
+    # one pass run concurrently and are all finished before the next pass, so
+    # a job never starts while its previous load is still running.
+    next_run = {name: time.monotonic() for name in intervals}
+    while not stopping:
+        ran = False
+        for name in sorted(next_run, key=next_run.get):
+            if stopping or next_run[name] > time.monotonic():
+                continue
+            run_job(name)
+            next_run[name] = time.monotonic() + intervals[name]
+            ran = True
+        wait_for_loads()
+        if ran and not stopping:
+            # ANALYZE / VACUUM only where the loads made it worthwhile, off-peak
+            run_maintenance()
+        if not stopping:
+            time.sleep(max(0, min(POLL_SECONDS, min(next_run.values()) - time.monotonic())))
+
+    stop_coordinator()
+    close_warm_connections()
+    debug_message("Daemon stopped.")
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["--once"]:
+        debug_message("Running every enabled job once.")
+        run_once()
+    else:
+        debug_message("Daemon started.")
+        run_forever()
@@ -0,0 +1,108 @@
+#!/usr/bin/env python
+
+import pyarrow as pa
+import pyarrow.compute as pc
+
+# VARCHAR widths are rounded up to a bucket with room to grow, so most new
+# values fit without widening the column
+VARCHAR_BUCKETS = [16, 32, 64, 128, 256, 512, 1024, 2048, 4096, 8192, 16384, 32768, 65535]
+VARCHAR_HEADROOM = 2
+DEFAULT_VARCHAR = 256
+
+def is_text(arrow_type):
+    return pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type)
+
+def measure_widths(table, widths=None):
+    # Longest value in bytes per string column; pass the previous result back
+    # in to keep a running maximum over several batches
+    widths = dict(widths or {})
+    for name, column in zip(table.column_names, table.columns):
+        if pa.types.is_dictionary(column.type):
+            # Interned columns only need their distinct values measured
+            if not is_text(column.type.value_type):
+                continue
+            longest = max((pc.max(pc.binary_length(chunk.dictionary)).as_py() or 0 for chunk in column.chunks), default=0)
+        elif is_text(column.type):
+            longest = pc.max(pc.binary_length(column)).as_py() or 0
+        else:
+            continue
+        widths[name] = max(widths.get(name, 0), longest)
+    return widths
+
+def varchar_width(longest):
+    if not longest:
+        return DEFAULT_VARCHAR
+    for bucket in VARCHAR_BUCKETS:
+        if bucket >= longest * VARCHAR_HEADROOM:
+            return bucket
+    return VARCHAR_BUCKETS[-1]
+
+def column_type(arrow_type, longest):
+    # AZ64 for numbers and dates, ZSTD for everything AZ64 does not support
+    if pa.types.is_boolean(arrow_type):
+        return "BOOLEAN", "ZSTD"
+    if pa.types.is_int8(arrow_type) or pa.types.is_int16(arrow_type):
+        return "SMALLINT", "AZ64"
+    if pa.types.is_int32(arrow_type):
+        return "INTEGER", "AZ64"
+    if pa.types.is_integer(arrow_type):
+        return "BIGINT", "AZ64"
+    if pa.types.is_float32(arrow_type):
+        return "REAL", "ZSTD"
+    if pa.types.is_floating(arrow_type):
+        return "DOUBLE PRECISION", "ZSTD"
+    if pa.types.is_decimal(arrow_type):
+        return f"DECIMAL({arrow_type.precision}, {arrow_type.scale})", "AZ64"
+    if pa.types.is_date(arrow_type):
+        return "DATE", "AZ64"
+    if pa.types.is_timestamp(arrow_type):
+        return ("TIMESTAMPTZ" if arrow_type.tz else "TIMESTAMP"), "AZ64"
+    return f"VARCHAR({varchar_width(longest)})", "ZSTD"
+
+def table_spec(schema, widths=None, sort_key=(), dist_key=None, diststyle=None):
+    widths = widths or {}
+    columns = []
+    for field in schema:
+        arrow_type = field.type.value_type if pa.types.is_dictionary(field.type) else field.type
+        redshift_type, encoding = column_type(arrow_type, widths.get(field.name))
+        # The leading sort key column stays uncompressed so zone maps stay selective
+        if sort_key and field.name == sort_key[0]:
+            encoding = "RAW"
+        columns.append((field.name, redshift_type, encoding))
+    return {
+        "columns": columns,
+        "sort_key": list(sort_key),
+        "dist_key": dist_key,
+        "diststyle": "KEY" if dist_key else (diststyle or "AUTO")
+    }
+
+def frame_spec(df, sort_key=(), dist_key=None, diststyle=None):
+    table = pa.Table.from_pandas(df, preserve_index=False)
+    return table_spec(table.schema, measure_widths(table), sort_key, dist_key, diststyle)
+
+def create_table_sql(table, spec):
+    columns = ",\n    ".join(f"{name} {redshift_type} ENCODE {encoding}" for name, redshift_type, encoding in spec["columns"])
+    statement = f"CREATE TABLE IF NOT EXISTS {table} (\n    {columns}\n) DISTSTYLE {spec['diststyle']}"
+    if spec["dist_key"]:
+        statement += f" DISTKEY ({spec['dist_key']})"
+    if spec["sort_key"]:
+        statement += f" COMPOUND SORTKEY ({', '.join(spec['sort_key'])})"
+    return statement + ";"
+
+def widen_statements(cur, table, spec):
+    # Incremental loads stage into a copy of the existing table, so any VARCHAR
+    # that has outgrown its width is widened first (never narrowed)
+    schema, name = table.split('.')
+    cur.execute(
+        "SELECT column_name, character_maximum_length FROM information_schema.columns "
+        "WHERE table_schema = %s AND table_name = %s AND character_maximum_length IS NOT NULL;",
+        (schema, name))
+    current = dict(cur.fetchall())
+    statements = []
+    for column_name, redshift_type, _ in spec["columns"]:
+        if not redshift_type.startswith("VARCHAR(") or column_name not in current:
+            continue
+        width = int(redshift_type[len("VARCHAR("):-1])
+        if width > current[column_name]:
+            statements.append(f"ALTER TABLE {table} ALTER COLUMN {column_name} TYPE VARCHAR({width});")
+    return statements
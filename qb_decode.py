@@ -0,0 +1,211 @@
+#!/usr/bin/env python
+
+import json
+from typing import Any, Dict, List, Optional
+
+try:
+    import msgspec
+except ImportError:
+    msgspec = None
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+# Entity pages are decoded straight into typed structures holding only the
+# fields the extractors use; everything else in the payload is skipped by the
+# decoder instead of being built into dicts. Entities without a structure here
+# are decoded generically. Without msgspec, orjson or the standard library
+# decoder is used for the whole page.
+
+def loads(content):
+    if orjson is not None:
+        return orjson.loads(content)
+    return json.loads(content)
+
+if msgspec is not None:
+
+    class Struct(msgspec.Struct, omit_defaults=True):
+        pass
+
+    class Ref(Struct):
+        value: Optional[str] = None
+        name: Optional[str] = None
+
+    class LinkedTxnRef(Struct):
+        TxnId: Optional[str] = None
+        TxnType: Optional[str] = None
+
+    class JournalEntity(Struct):
+        Type: Optional[str] = None
+        EntityRef: Optional[Ref] = None
+
+    class JournalLineDetail(Struct):
+        PostingType: Optional[str] = None
+        Entity: Optional[JournalEntity] = None
+        AccountRef: Optional[Ref] = None
+        ClassRef: Optional[Ref] = None
+        DepartmentRef: Optional[Ref] = None
+
+    class JournalEntryLine(Struct):
+        Id: Optional[str] = None
+        Description: Optional[str] = None
+        Amount: Optional[float] = None
+        DetailType: Optional[str] = None
+        JournalEntryLineDetail: Optional[JournalLineDetail] = None
+
+    class JournalEntry(Struct):
+        Id: str
+        SyncToken: Optional[str] = None
+        Adjustment: Optional[bool] = None
+        DocNumber: Optional[str] = None
+        TxnDate: Optional[str] = None
+        PrivateNote: Optional[str] = None
+        Line: List[JournalEntryLine] = []
+
+    class ExpenseLineDetail(Struct):
+        AccountRef: Optional[Ref] = None
+        ItemRef: Optional[Ref] = None
+        Qty: Optional[float] = None
+        UnitPrice: Optional[float] = None
+        BillableStatus: Optional[str] = None
+        TaxCodeRef: Optional[Ref] = None
+        CustomerRef: Optional[Ref] = None
+        ClassRef: Optional[Ref] = None
+
+    class ExpenseLine(Struct):
+        Id: Optional[str] = None
+        LineNum: Optional[int] = None
+        Description: Optional[str] = None
+        Amount: Optional[float] = None
+        DetailType: Optional[str] = None
+        AccountBasedExpenseLineDetail: Optional[ExpenseLineDetail] = None
+        ItemBasedExpenseLineDetail: Optional[ExpenseLineDetail] = None
+
+    class Purchase(Struct):
+        Id: str
+        SyncToken: Optional[str] = None
+        PaymentType: Optional[str] = None
+        Credit: Optional[bool] = None
+        TotalAmt: Optional[float] = None
+        TxnDate: Optional[str] = None
+        PrivateNote: Optional[str] = None
+        AccountRef: Optional[Ref] = None
+        EntityRef: Optional[Ref] = None
+        Line: List[ExpenseLine] = []
+
+    class Bill(Struct):
+        Id: str
+        SyncToken: Optional[str] = None
+        DueDate: Optional[str] = None
+        Balance: Optional[float] = None
+        DocNumber: Optional[str] = None
+        TxnDate: Optional[str] = None
+        PrivateNote: Optional[str] = None
+        VendorRef: Optional[Ref] = None
+        APAccountRef: Optional[Ref] = None
+        LinkedTxn: Optional[List[LinkedTxnRef]] = None
+        Line: Optional[List[ExpenseLine]] = None
+
+    class DepositEntity(Struct):
+        value: Optional[str] = None
+        name: Optional[str] = None
+        type: Optional[str] = None
+
+    class DepositDetail(Struct):
+        AccountRef: Optional[Ref] = None
+        Entity: Optional[DepositEntity] = None
+        PaymentMethodRef: Optional[Ref] = None
+        CheckNum: Optional[str] = None
+        ClassRef: Optional[Ref] = None
+
+    class DepositLine(Struct):
+        Id: Optional[str] = None
+        LineNum: Optional[int] = None
+        Description: Optional[str] = None
+        Amount: Optional[float] = None
+        DetailType: Optional[str] = None
+        DepositLineDetail: Optional[DepositDetail] = None
+        LinkedTxn: Optional[List[LinkedTxnRef]] = None
+
+    class Deposit(Struct):
+        Id: str
+        SyncToken: Optional[str] = None
+        TotalAmt: Optional[float] = None
+        TxnDate: Optional[str] = None
+        PrivateNote: Optional[str] = None
+        DocNumber: Optional[str] = None
+        DepositToAccountRef: Optional[Ref] = None
+        CurrencyRef: Optional[Ref] = None
+        Line: List[DepositLine] = []
+
+    class CheckPaymentDetail(Struct):
+        BankAccountRef: Optional[Ref] = None
+
+    class CreditCardPaymentDetail(Struct):
+        CCAccountRef: Optional[Ref] = None
+
+    class BillPaymentLine(Struct):
+        Amount: Optional[float] = None
+        LinkedTxn: List[LinkedTxnRef] = []
+
+    class BillPayment(Struct):
+        Id: str
+        SyncToken: Optional[str] = None
+        PayType: Optional[str] = None
+        TotalAmt: Optional[float] = None
+        TxnDate: Optional[str] = None
+        DocNumber: Optional[str] = None
+        VendorRef: Optional[Ref] = None
+        CheckPayment: Optional[CheckPaymentDetail] = None
+        CreditCardPayment: Optional[CreditCardPaymentDetail] = None
+        Line: List[BillPaymentLine] = []
+
+    ENTITY_TYPES = {
+        "JournalEntry": List[JournalEntry],
+        "Purchase": List[Purchase],
+        "Bill": List[Bill],
+        "Deposit": List[Deposit],
+        "BillPayment": List[BillPayment]
+    }
+
+    class QueryEnvelope(msgspec.Struct):
+        QueryResponse: Dict[str, msgspec.Raw] = {}
+
+    class BatchItem(msgspec.Struct):
+        bId: Optional[str] = None
+        QueryResponse: Optional[Dict[str, msgspec.Raw]] = None
+        Fault: Optional[Any] = None
+
+    class BatchEnvelope(msgspec.Struct):
+        BatchItemResponse: List[BatchItem] = []
+
+    def decode_fields(fields):
+        # Typed entity lists go through their structure; counts, positions and
+        # untyped entities are decoded as plain values
+        query_response = {}
+        for key, raw in fields.items():
+            if key in ENTITY_TYPES:
+                query_response[key] = msgspec.to_builtins(msgspec.json.decode(raw, type=ENTITY_TYPES[key]))
+            else:
+                query_response[key] = msgspec.json.decode(raw)
+        return query_response
+
+def decode_query_response(content):
+    if msgspec is None:
+        return loads(content).get("QueryResponse", {})
+    return decode_fields(msgspec.json.decode(content, type=QueryEnvelope).QueryResponse)
+
+def decode_batch_response(content):
+    if msgspec is None:
+        return loads(content).get("BatchItemResponse", [])
+    items = []
+    for item in msgspec.json.decode(content, type=BatchEnvelope).BatchItemResponse:
+        decoded = {"bId": item.bId}
+        if item.QueryResponse is not None:
+            decoded["QueryResponse"] = decode_fields(item.QueryResponse)
+        if item.Fault is not None:
+            decoded["Fault"] = item.Fault
+        items.append(decoded)
+    return items
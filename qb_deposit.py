@@ -1,16 +1,21 @@
 #!/usr/bin/env python
 
-import requests
 import base64
 import pandas as pd
 import os
-from dotenv import load_dotenv
 import pyarrow as pa
 import pyarrow.parquet as pq
 import boto3
 from io import BytesIO
 import psycopg2
+from qb_common import load_credentials, get_path, to_int
+from qb_query import get_session, fetch_entity
 import datetime
+from qb_dimensions import slim_names
+from qb_ddl import frame_spec
+from qb_s3 import write_parquet, swap_if_changed
+from qb_coordinator import submit_load
+from qb_validate import gate, check_row_count
 
 def debug_message(message):
     timestamp = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
@@ -39,44 +44,72 @@ def execute_sql(sql_query):
     except Exception as e:
         error_message(f"An error occurred while executing SQL query: {str(e)}")
 
+def flatten_deposit_lines(deposit_ids, txn_dates, lines):
+    # One typed row per deposit line, keyed by (deposit_id, line_id); lines
+    # that record a received payment carry it in LinkedTxn instead of a detail block
+    rows = []
+    for deposit_id, txn_date, deposit_lines in zip(deposit_ids, txn_dates, lines):
+        if not isinstance(deposit_lines, list):
+            continue
+        for line in deposit_lines:
+            detail = line.get("DepositLineDetail", {})
+            linked_txn = (line.get("LinkedTxn") or [{}])[0]
+            rows.append({
+                "deposit_id": to_int(deposit_id),
+                "line_id": to_int(line.get("Id")),
+                "line_num": to_int(line.get("LineNum")),
+                "txn_date": txn_date,
+                "description": line.get("Description"),
+                "amount": line.get("Amount"),
+                "detail_type": line.get("DetailType"),
+                "account_ref_value": to_int(get_path(detail, "AccountRef.value")),
+                "account_ref_name": get_path(detail, "AccountRef.name"),
+                "entity_ref_value": to_int(get_path(detail, "Entity.value")),
+                "entity_ref_name": get_path(detail, "Entity.name"),
+                "entity_type": get_path(detail, "Entity.type"),
+                "payment_method_ref_value": to_int(get_path(detail, "PaymentMethodRef.value")),
+                "check_num": detail.get("CheckNum"),
+                "class_ref_value": to_int(get_path(detail, "ClassRef.value")),
+                "linked_txn_id": to_int(linked_txn.get("TxnId")),
+                "linked_txn_type": linked_txn.get("TxnType")
+            })
+    df_lines = pd.DataFrame(rows, columns=[
+        "deposit_id", "line_id", "line_num", "txn_date", "description", "amount", "detail_type",
+        "account_ref_value", "account_ref_name", "entity_ref_value", "entity_ref_name", "entity_type",
+        "payment_method_ref_value", "check_num", "class_ref_value", "linked_txn_id", "linked_txn_type"
+    ])
+    df_lines = df_lines.astype({
+        "deposit_id": "Int32",
+        "line_id": "Int32",
+        "line_num": "Int32",
+        "description": "string",
+        "amount": "float64",
+        "detail_type": "string",
+        "account_ref_value": "Int32",
+        "account_ref_name": "string",
+        "entity_ref_value": "Int32",
+        "entity_ref_name": "string",
+        "entity_type": "string",
+        "payment_method_ref_value": "Int32",
+        "check_num": "string",
+        "class_ref_value": "Int32",
+        "linked_txn_id": "Int32",
+        "linked_txn_type": "string"
+    })
+    df_lines["txn_date"] = pd.to_datetime(df_lines["txn_date"], errors='coerce')
+    return df_lines
+
 def fetch_quickbooks_data():
     try:
         debug_message("Fetching QuickBooks data...")
-        load_dotenv("/home/sameen/qb_scripts/.env")
-        load_dotenv("/home/sameen/qb_scripts/.env_access")
-        client_id = os.getenv("CLIENT_ID")
-        client_secret = os.getenv("CLIENT_SECRET")
-        refresh_token = os.getenv("REFRESH_TOKEN")
-        realm_id = os.getenv("REALM_ID")
-        access_token = os.getenv("CURR_AUTH_TOKEN")
-        if not all([client_id, client_secret, refresh_token, realm_id, access_token]):
-            error_message("Missing required credentials. Check .env and .env_access files.")
+        credentials = load_credentials()
+        if credentials is None:
             return None
-        
-        url_query = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/query"
-        select_statement = "select * from Deposit"
-        headers_query = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "text/plain",
-            "Accept": "application/json",
-        }
-        all_data = []  
-        has_more = True
-        start_position = 1
-        while has_more:
-            params_query = {
-                "query": f"{select_statement} STARTPOSITION {start_position}",
-            }
-            response_query = requests.get(url_query, headers=headers_query, params=params_query)
-            if response_query.status_code != 200:
-                error_message(f"Failed to fetch data from QuickBooks API. Status code: {response_query.status_code}")
-                return None
-            response_json = response_query.json()
-            query_response = response_json.get("QueryResponse", {})
-            deposits = query_response.get("Deposit", [])
-            all_data.extend(deposits)  
-            start_position += len(deposits)
-            has_more = query_response.get("maxResults") == 100
+
+        session = get_session(credentials)
+        counts = {}
+        all_data = fetch_entity(session, credentials["realm_id"], "Deposit", counts=counts)
+        gate("Deposit extract", check_row_count("Deposit", all_data, counts.get("Deposit")))
         df_selected = pd.json_normalize(all_data)  
         return df_selected
     except Exception as e:
@@ -97,6 +130,9 @@ try:
 
         df_selected = df_selected[selected_columns]
 
+        # Deposit lines go to their own typed child table instead of being parsed from JSON in Redshift
+        df_lines = flatten_deposit_lines(df_selected['Id'], df_selected['TxnDate'], df_selected['Line'])
+
         df_selected.columns = ["".join(["_" + char.lower() if char.isupper() else char for char in col]).lstrip("_") for col in selected_columns]
 
         df_selected.columns = df_selected.columns.str.replace('.', '_')
@@ -115,45 +151,26 @@ try:
         }
         df_selected = df_selected.astype(data_types)
 
+        # Type dates here so the Parquet file matches the final table column for column
+        df_selected['txn_date'] = pd.to_datetime(df_selected['txn_date'], errors='coerce')
+
+        # Names live in the qb_dim_* tables; optionally keep only the ids in the fact rows
+        df_selected = slim_names(df_selected, ['deposit_to_account_ref_name'])
+
         s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_deposit.parquet'
         # Write DataFrame to Parquet with the specified column names
-        df_selected.to_parquet(s3_url)
-
-        # Define SQL statements
-        sql_statements = [
-            """CREATE TABLE finance.temp_qb_deposit (
-                total_amt DOUBLE PRECISION,
-                id INT,  
-                txn_date VARCHAR(255),
-                private_note VARCHAR(514),
-                line VARCHAR(65535), 
-                deposit_to_account_ref_value INT,
-                deposit_to_account_ref_name VARCHAR(255),
-                currency_ref_value VARCHAR(3),
-                currency_ref_name VARCHAR(50),
-                doc_number VARCHAR(255)
-            );""",
-            f"COPY finance.temp_qb_deposit FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-            "TRUNCATE TABLE finance.qb_deposit;",
-            """INSERT INTO finance.qb_deposit
-               SELECT 
-                   total_amt,
-                   id,
-                   TO_TIMESTAMP(txn_date, 'YYYY-MM-DD HH24:MI:SS'), -- Cast txn_date to TIMESTAMP
-                   private_note,
-                   line,
-                   deposit_to_account_ref_value,
-                   deposit_to_account_ref_name,
-                   currency_ref_value,
-                   currency_ref_name,
-                   doc_number
-               FROM finance.temp_qb_deposit;""",
-            "DROP TABLE finance.temp_qb_deposit;"
-        ]
-
-        # Execute SQL statements
-        for sql_statement in sql_statements:
-            execute_sql(sql_statement)
+        digest = write_parquet(df_selected, s3_url, coerce_timestamps='us', allow_truncated_timestamps=True)
+
+        df_lines = slim_names(df_lines, ['account_ref_name', 'entity_ref_name'])
+        lines_s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_deposit_line.parquet'
+        lines_digest = write_parquet(df_lines, lines_s3_url, coerce_timestamps='us', allow_truncated_timestamps=True)
+
+        # Load with a single COPY and an atomic swap into finance.qb_deposit and finance.qb_deposit_line,
+        # unless a file is exactly what the last successful run loaded
+        submit_load('finance.qb_deposit', swap_if_changed, 'finance.qb_deposit', s3_url, digest,
+                    frame_spec(df_selected, sort_key=('txn_date',), dist_key='id'), df_selected)
+        submit_load('finance.qb_deposit_line', swap_if_changed, 'finance.qb_deposit_line', lines_s3_url, lines_digest,
+                    frame_spec(df_lines, sort_key=('txn_date',), dist_key='deposit_id'), df_lines)
             
     else:
         error_message("Failed to fetch QuickBooks data. Exiting script.")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import os
+import json
+import sqlite3
+import pandas as pd
+from qb_common import debug_message, error_message, load_credentials, S3_PREFIX
+from qb_query import get_session, fetch_entities
+from qb_ddl import frame_spec
+from qb_s3 import write_parquet, swap_if_changed
+from qb_coordinator import submit_load
+
+# Local cache of reference entities, refreshed incrementally by LastUpdatedTime
+CACHE_PATH = os.getenv("QB_DIMENSION_CACHE", "/home/sameen/qb_scripts/qb_dimensions.sqlite")
+
+# Per entity: target table, the field used as its name, and extra narrow columns
+DIMENSIONS = {
+    "Account": {
+        "table": "finance.qb_dim_account",
+        "name": "Name",
+        "extra": {"account_type": "AccountType", "account_sub_type": "AccountSubType", "acct_num": "AcctNum"}
+    },
+    "Vendor": {
+        "table": "finance.qb_dim_vendor",
+        "name": "DisplayName",
+        "extra": {"company_name": "CompanyName"}
+    },
+    "Customer": {
+        "table": "finance.qb_dim_customer",
+        "name": "DisplayName",
+        "extra": {"company_name": "CompanyName"}
+    },
+    "Class": {
+        "table": "finance.qb_dim_class",
+        "name": "Name",
+        "extra": {}
+    },
+    "Department": {
+        "table": "finance.qb_dim_department",
+        "name": "Name",
+        "extra": {}
+    }
+}
+
+def open_cache(path=None):
+    conn = sqlite3.connect(path or CACHE_PATH)
+    conn.execute("""CREATE TABLE IF NOT EXISTS dimension (
+        entity TEXT NOT NULL,
+        id TEXT NOT NULL,
+        name TEXT,
+        last_updated TEXT,
+        payload TEXT NOT NULL,
+        PRIMARY KEY (entity, id)
+    ) WITHOUT ROWID;""")
+    return conn
+
+def id_only_facts():
+    # When set, fact tables keep their *_name columns but leave them empty;
+    # names are resolved by joining the qb_dim_* tables instead
+    return os.getenv("QB_ID_ONLY_FACTS", "").lower() in ("1", "true", "yes")
+
+def refresh_dimensions(session, realm_id, entities=None):
+    # Pull only the rows changed since the newest LastUpdatedTime in the cache,
+    # all entities packed into the same batch calls
+    entities = list(entities or DIMENSIONS)
+    conn = open_cache()
+    try:
+        where = {}
+        for entity in entities:
+            watermark = conn.execute("SELECT MAX(last_updated) FROM dimension WHERE entity = ?;", (entity,)).fetchone()[0]
+            where[entity] = "Active IN (true, false)"
+            if watermark:
+                where[entity] += f" AND MetaData.LastUpdatedTime > '{watermark}'"
+
+        changed = fetch_entities(session, realm_id, entities, where)
+        with conn:
+            for entity, records in changed.items():
+                name_field = DIMENSIONS[entity]["name"]
+                conn.executemany(
+                    "INSERT OR REPLACE INTO dimension (entity, id, name, last_updated, payload) VALUES (?, ?, ?, ?, ?);",
+                    [(entity, record["Id"], record.get(name_field), record.get("MetaData", {}).get("LastUpdatedTime"), json.dumps(record))
+                     for record in records])
+                debug_message(f"{entity}: {len(records)} cached records refreshed.")
+    finally:
+        conn.close()
+    return {entity: len(records) for entity, records in changed.items()}
+
+def cached_records(entity):
+    conn = open_cache()
+    try:
+        return [json.loads(row[0]) for row in conn.execute("SELECT payload FROM dimension WHERE entity = ?;", (entity,))]
+    finally:
+        conn.close()
+
+def slim_names(df, name_columns):
+    if not id_only_facts():
+        return df
+    for col in name_columns:
+        if col in df.columns:
+            df[col] = pd.Series(pd.NA, index=df.index, dtype='string')
+    return df
+
+def dimension_frame(entity):
+    spec = DIMENSIONS[entity]
+    records = cached_records(entity)
+    df = pd.DataFrame({
+        'id': pd.Series([int(record["Id"]) for record in records], dtype='int32'),
+        'name': pd.Series([record.get(spec["name"]) for record in records], dtype='string'),
+        'fully_qualified_name': pd.Series([record.get("FullyQualifiedName") for record in records], dtype='string'),
+        'parent_id': pd.Series([int(record["ParentRef"]["value"]) if "ParentRef" in record else None for record in records], dtype='Int32'),
+        'active': pd.Series([record.get("Active") for record in records], dtype='boolean'),
+        'last_updated_time': pd.to_datetime([record.get("MetaData", {}).get("LastUpdatedTime") for record in records], utc=True, errors='coerce').tz_convert(None)
+    })
+    for col, field in spec["extra"].items():
+        df[col] = pd.Series([record.get(field) for record in records], dtype='string')
+    return df
+
+if __name__ == "__main__":
+    try:
+        debug_message("Script started.")
+        credentials = load_credentials()
+        if credentials is None:
+            raise SystemExit(1)
+        session = get_session(credentials)
+        refresh_dimensions(session, credentials["realm_id"])
+
+        # Every dimension is rebuilt from the cache, even when this run fetched
+        # nothing new: other scripts refresh the cache too (the vendor report,
+        # backfills) and a failed swap has to be retried. An unchanged file is
+        # neither uploaded nor loaded again.
+        for entity, spec in DIMENSIONS.items():
+            df = dimension_frame(entity)
+            s3_url = f"{S3_PREFIX}/{spec['table'].split('.')[1]}.parquet"
+            digest = write_parquet(df, s3_url, coerce_timestamps='us', allow_truncated_timestamps=True)
+            debug_message(f"{len(df)} {entity} rows saved to Parquet file: {s3_url}")
+            submit_load(spec["table"], swap_if_changed, spec["table"], s3_url, digest,
+                        frame_spec(df, sort_key=('id',), diststyle='ALL'), df)
+    except Exception as e:
+        error_message(f"An unexpected error occurred: {str(e)}")
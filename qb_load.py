@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+
+import os
+import uuid
+from qb_common import debug_message, error_message, get_redshift_connection
+from qb_ddl import create_table_sql, widen_statements
+from qb_maintenance import record_changes
+
+# Readers keep their grants across a swap only if they are re-issued on the new table
+def read_groups():
+    return [group.strip() for group in os.getenv("REDSHIFT_READ_GROUPS", "").split(",") if group.strip()]
+
+# A compacted directory lists its live files in a COPY manifest of this name
+MANIFEST_NAME = "_manifest.json"
+
+def copy_statement(table, s3_url):
+    manifest = " MANIFEST" if s3_url.endswith(MANIFEST_NAME) else ""
+    return f"COPY {table} FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET{manifest};"
+
+def split_table_name(table):
+    schema, name = table.split('.')
+    return schema, name
+
+def staging_name(table):
+    # Unique per load, so concurrent or overlapping loads never share a staging table
+    schema, name = split_table_name(table)
+    return f"{schema}.{name}_staging_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+
+def prepare_target(conn, cur, table, spec):
+    # Create the target from its generated DDL on first load and widen any
+    # VARCHAR the new data has outgrown; ALTER COLUMN cannot run in a transaction
+    if spec is None:
+        return
+    conn.autocommit = True
+    cur.execute(create_table_sql(table, spec))
+    for statement in widen_statements(cur, table, spec):
+        debug_message(f"Widening column: {statement}")
+        cur.execute(statement)
+    conn.autocommit = False
+
+def drop_staging(conn, staging):
+    # Best effort after a failed load; staging names are unique, so nothing
+    # else would ever clean them up
+    try:
+        conn.rollback()
+        conn.autocommit = True
+        conn.cursor().execute(f"DROP TABLE IF EXISTS {staging};")
+    except Exception as e:
+        error_message(f"Could not drop {staging}: {str(e)}")
+
+def stage_table(cur, table, s3_url, staging, spec=None):
+    # Without a spec, LIKE keeps the distribution style, sort key and encodings
+    # of the target; either way the Parquet file has to be written in the final
+    # column order and types
+    cur.execute(f"DROP TABLE IF EXISTS {staging};")
+    if spec is None:
+        cur.execute(f"CREATE TABLE {staging} (LIKE {table});")
+    else:
+        cur.execute(create_table_sql(staging, spec))
+    cur.execute(copy_statement(staging, s3_url))
+
+def swap_load(table, s3_url, spec=None):
+    # Full refresh: one COPY into a final-shaped staging table, then a rename
+    # swap inside a single transaction so readers never see an empty table.
+    # With a spec the staging table is built from freshly generated DDL, so a
+    # full refresh also picks up new keys, encodings and VARCHAR widths.
+    # Views over the table must be late-binding (WITH NO SCHEMA BINDING).
+    schema, name = split_table_name(table)
+    staging = staging_name(table)
+    # Unique like the staging table, so overlapping swaps never retire into the same name
+    retired = f"{name}_retired_{os.getpid()}_{uuid.uuid4().hex[:8]}"
+    conn = None
+    try:
+        debug_message(f"Swap loading {table} from {s3_url}")
+        conn = get_redshift_connection()
+        cur = conn.cursor()
+        if spec is not None:
+            # New tables are created on first load so there is something to swap against
+            cur.execute(create_table_sql(table, spec))
+        stage_table(cur, table, s3_url, staging, spec)
+        conn.commit()
+
+        cur.execute(f"ALTER TABLE {table} RENAME TO {retired};")
+        cur.execute(f"ALTER TABLE {staging} RENAME TO {name};")
+        for group in read_groups():
+            cur.execute(f"GRANT SELECT ON {table} TO GROUP {group};")
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        if conn is not None:
+            drop_staging(conn, staging)
+            conn.close()
+        error_message(f"An error occurred while swap loading {table}: {str(e)}")
+        return False
+
+    # The swap has committed; a retired table left behind is only reported
+    try:
+        cur = conn.cursor()
+        cur.execute(f"DROP TABLE {schema}.{retired};")
+        conn.commit()
+        cur.close()
+    except Exception as e:
+        error_message(f"{table} was swapped in but {schema}.{retired} could not be dropped: {str(e)}")
+    finally:
+        conn.close()
+    record_changes(table, 0, reset=True)
+    debug_message(f"{table} swapped in successfully.")
+    return True
+
+def append_load(table, s3_url, spec=None):
+    # Append-only loads: COPY into a staging table and move its blocks into the
+    # target with ALTER TABLE APPEND, which cannot run inside a transaction
+    schema, name = split_table_name(table)
+    staging = staging_name(table)
+    conn = None
+    try:
+        debug_message(f"Append loading {table} from {s3_url}")
+        conn = get_redshift_connection()
+        cur = conn.cursor()
+        prepare_target(conn, cur, table, spec)
+        stage_table(cur, table, s3_url, staging)
+        cur.execute(f"SELECT COUNT(*) FROM {staging};")
+        appended = cur.fetchone()[0]
+        conn.commit()
+
+        conn.autocommit = True
+        cur.execute(f"ALTER TABLE {table} APPEND FROM {staging};")
+        cur.execute(f"DROP TABLE {staging};")
+        cur.close()
+        record_changes(table, appended)
+        debug_message(f"{table} appended successfully.")
+        return True
+    except Exception as e:
+        if conn is not None:
+            drop_staging(conn, staging)
+        error_message(f"An error occurred while append loading {table}: {str(e)}")
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+
+def merge_load(table, s3_url, key='id', deleted_ids=(), spec=None):
+    # Incremental: replace the rows of every changed key and drop deleted keys
+    # in one transaction. s3_url may be None when there are only deletions.
+    schema, name = split_table_name(table)
+    staging = staging_name(table)
+    conn = None
+    try:
+        debug_message(f"Merge loading {table} from {s3_url}")
+        conn = get_redshift_connection()
+        cur = conn.cursor()
+        prepare_target(conn, cur, table, spec)
+        # Deleted plus inserted rows, for the post-load maintenance thresholds
+        changed = 0
+        if s3_url is not None:
+            stage_table(cur, table, s3_url, staging)
+            cur.execute(f"DELETE FROM {table} USING {staging} WHERE {table}.{key} = {staging}.{key};")
+            changed += max(0, cur.rowcount)
+        deleted_ids = list(deleted_ids)
+        for offset in range(0, len(deleted_ids), 1000):
+            cur.execute(f"DELETE FROM {table} WHERE {key} IN %s;", (tuple(deleted_ids[offset:offset + 1000]),))
+            changed += max(0, cur.rowcount)
+        if s3_url is not None:
+            cur.execute(f"INSERT INTO {table} SELECT * FROM {staging};")
+            changed += max(0, cur.rowcount)
+            cur.execute(f"DROP TABLE {staging};")
+        conn.commit()
+        cur.close()
+        record_changes(table, changed)
+        debug_message(f"{table} merged successfully.")
+        return True
+    except Exception as e:
+        if conn is not None:
+            conn.rollback()
+        error_message(f"An error occurred while merge loading {table}: {str(e)}")
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+
+import os
+import sys
+import time
+import sqlite3
+import datetime
+from qb_common import debug_message, error_message, get_redshift_connection
+
+# Post-load table maintenance, run only when it is needed and only off-peak.
+# The loaders record how many rows each load changed; ANALYZE runs once the
+# changes since the last one reach ANALYZE_CHANGED_SHARE of the table, and
+# VACUUM SORT ONLY / DELETE ONLY once SVV_TABLE_INFO shows enough unsorted or
+# deleted rows. A swap load builds a fresh, sorted table with its statistics
+# already computed by the COPY, so it resets the table's count.
+STATE_PATH = os.getenv("QB_MAINTENANCE_DB", "/home/sameen/qb_scripts/qb_maintenance.sqlite")
+
+ANALYZE_CHANGED_SHARE = float(os.getenv("QB_ANALYZE_CHANGED_SHARE", "0.10"))
+VACUUM_UNSORTED_PERCENT = float(os.getenv("QB_VACUUM_UNSORTED_PERCENT", "10"))
+VACUUM_DELETED_PERCENT = float(os.getenv("QB_VACUUM_DELETED_PERCENT", "10"))
+
+# Local hours in which maintenance may run, start-end, wrapping past midnight
+MAINTENANCE_WINDOW = os.getenv("QB_MAINTENANCE_WINDOW", "22-6")
+
+# A table without recorded changes is still looked at this often for vacuum
+CHECK_SECONDS = 86400
+
+def open_state(path=None):
+    conn = sqlite3.connect(path or STATE_PATH, timeout=30)
+    conn.execute("""CREATE TABLE IF NOT EXISTS table_change (
+        table_name TEXT PRIMARY KEY,
+        rows_changed INTEGER NOT NULL,
+        checked REAL NOT NULL
+    ) WITHOUT ROWID;""")
+    return conn
+
+def record_changes(table, rows, reset=False):
+    # Called by the loaders after a successful commit
+    try:
+        conn = open_state()
+        try:
+            with conn:
+                conn.execute("INSERT OR IGNORE INTO table_change (table_name, rows_changed, checked) VALUES (?, 0, 0);", (table,))
+                if reset:
+                    conn.execute("UPDATE table_change SET rows_changed = 0 WHERE table_name = ?;", (table,))
+                else:
+                    conn.execute("UPDATE table_change SET rows_changed = rows_changed + ? WHERE table_name = ?;", (max(0, rows), table))
+        finally:
+            conn.close()
+    except Exception as e:
+        error_message(f"Could not record changes for {table}: {str(e)}")
+
+def in_window(now=None):
+    now = now or datetime.datetime.now()
+    start, end = (int(hour) for hour in MAINTENANCE_WINDOW.split("-"))
+    if start <= end:
+        return start <= now.hour < end
+    return now.hour >= start or now.hour < end
+
+def due_tables():
+    conn = open_state()
+    try:
+        return conn.execute("SELECT table_name, rows_changed FROM table_change WHERE rows_changed > 0 OR checked < ? ORDER BY table_name;",
+                            (time.time() - CHECK_SECONDS,)).fetchall()
+    finally:
+        conn.close()
+
+def table_info(cur, table):
+    # (visible rows, unsorted percent, deleted percent), or None if the table is gone
+    schema, name = table.split('.')
+    cur.execute("""SELECT tbl_rows, estimated_visible_rows, unsorted FROM svv_table_info
+                   WHERE "schema" = %s AND "table" = %s;""", (schema, name))
+    row = cur.fetchone()
+    if row is None:
+        return None
+    total, visible, unsorted = (float(value or 0) for value in row)
+    deleted = 100.0 * (total - visible) / total if total > 0 else 0.0
+    return visible, unsorted, deleted
+
+def maintenance_statements(table, rows_changed, info):
+    visible, unsorted, deleted = info
+    statements = []
+    if rows_changed > 0 and rows_changed >= ANALYZE_CHANGED_SHARE * max(visible, 1):
+        statements.append(f"ANALYZE {table} PREDICATE COLUMNS;")
+    if deleted >= VACUUM_DELETED_PERCENT:
+        statements.append(f"VACUUM DELETE ONLY {table} TO 100 PERCENT;")
+    if unsorted >= VACUUM_UNSORTED_PERCENT:
+        statements.append(f"VACUUM SORT ONLY {table} TO 99 PERCENT;")
+    return statements
+
+def mark_checked(table, analyzed):
+    conn = open_state()
+    try:
+        with conn:
+            if analyzed:
+                conn.execute("UPDATE table_change SET rows_changed = 0, checked = ? WHERE table_name = ?;", (time.time(), table))
+            else:
+                conn.execute("UPDATE table_change SET checked = ? WHERE table_name = ?;", (time.time(), table))
+    finally:
+        conn.close()
+
+def run_maintenance(force=False):
+    if not force and not in_window():
+        return
+    tables = due_tables()
+    if not tables:
+        return
+    conn = None
+    try:
+        conn = get_redshift_connection()
+        # VACUUM cannot run inside a transaction block
+        conn.autocommit = True
+        cur = conn.cursor()
+        for table, rows_changed in tables:
+            info = table_info(cur, table)
+            if info is None:
+                mark_checked(table, True)
+                continue
+            statements = maintenance_statements(table, rows_changed, info)
+            for statement in statements:
+                started = time.monotonic()
+                debug_message(f"Maintenance: {statement}")
+                cur.execute(statement)
+                debug_message(f"Maintenance on {table} finished in {time.monotonic() - started:.1f}s.")
+            mark_checked(table, any(statement.startswith("ANALYZE") for statement in statements))
+        cur.close()
+    except Exception as e:
+        error_message(f"An error occurred during table maintenance: {str(e)}")
+    finally:
+        if conn is not None:
+            conn.autocommit = False
+            conn.close()
+
+if __name__ == "__main__":
+    # --force runs outside the maintenance window
+    run_maintenance(force="--force" in sys.argv[1:])
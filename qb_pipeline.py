@@ -0,0 +1,317 @@
+#!/usr/bin/env python
+
+import os
+import queue
+import threading
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import fsspec
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from qb_common import debug_message, error_message
+from qb_query import iter_entity_pages, PAGE_SIZE
+from qb_change_index import start_changes, track_changes, finish_changes
+from qb_validate import gate, check_row_count
+from qb_s3 import PART_SIZE
+
+# Staged extracts: every stage runs on its own thread with a bounded queue to
+# the next one, so page N+1 downloads while page N is flattened and the
+# Parquet bytes of page N-1 are uploading. A full queue makes the stage in
+# front of it wait, so memory in the stages stays at a few pages each however
+# large the extract is, and the run takes about as long as its slowest stage.
+# What comes out of the last stage is kept and returned to the caller.
+QUEUE_DEPTH = int(os.getenv("QB_PIPELINE_DEPTH", "4"))
+
+# With more than one process, pages are flattened in a process pool and come
+# back as Arrow IPC streams, in page order; 1 keeps flattening on the
+# pipeline's own thread
+FLATTEN_PROCESSES = int(os.getenv("QB_FLATTEN_PROCESSES", "1"))
+
+DONE = object()
+
+def run_pipeline(source, *stages, depth=None):
+    # source is any iterable, consumed on its own thread; each stage is called
+    # with one item and returns the item for the next stage (None drops it).
+    # Returns what comes out of the last stage as a list. The first error in
+    # any stage stops them all and is raised here.
+    depth = depth or QUEUE_DEPTH
+    queues = [queue.Queue(maxsize=depth) for _ in range(len(stages) + 1)]
+    stop = threading.Event()
+    failed = []
+
+    def put(target, item):
+        while not stop.is_set():
+            try:
+                target.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(source_queue):
+        while not stop.is_set():
+            try:
+                return source_queue.get(timeout=0.1)
+            except queue.Empty:
+                continue
+        return DONE
+
+    def fail(e):
+        failed.append(e)
+        stop.set()
+
+    def feed():
+        try:
+            for item in source:
+                if not put(queues[0], item):
+                    return
+        except Exception as e:
+            fail(e)
+        put(queues[0], DONE)
+
+    def work(index, stage):
+        while True:
+            item = get(queues[index])
+            if item is DONE:
+                put(queues[index + 1], DONE)
+                return
+            try:
+                result = stage(item)
+            except Exception as e:
+                fail(e)
+                return
+            if result is not None:
+                put(queues[index + 1], result)
+
+    threads = [threading.Thread(target=feed, name="qb-pipeline-source", daemon=True)]
+    threads += [threading.Thread(target=work, args=(index, stage), name=f"qb-pipeline-{index}", daemon=True)
+                for index, stage in enumerate(stages)]
+    for thread in threads:
+        thread.start()
+    results = []
+    while True:
+        item = get(queues[-1])
+        if item is DONE:
+            break
+        results.append(item)
+    for thread in threads:
+        thread.join()
+    if failed:
+        raise failed[0]
+    return results
+
+class ChunkSink:
+    # Write target for a ParquetWriter that hands the bytes written so far
+    # over in pieces; the writer still sees one continuous file
+    def __init__(self):
+        self.chunks = []
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        data = bytes(data)
+        self.chunks.append(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+    def writable(self):
+        return True
+
+    def take(self):
+        data = b"".join(self.chunks)
+        self.chunks = []
+        return data
+
+def flatten_to_ipc(module_name, records):
+    # Runs in a pool process: the module's build_frame on one chunk of
+    # records, handed back as the bytes of an Arrow IPC stream
+    build_frame = importlib.import_module(module_name).build_frame
+    table = pa.Table.from_pandas(build_frame(records), preserve_index=False)
+    sink = pa.BufferOutputStream()
+    with pa.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+def read_ipc(data):
+    return pa.ipc.open_stream(data).read_all()
+
+class ProcessFlatten:
+    # build_frame of module_name in a pool of processes. Workers are spawned,
+    # not forked, since the parent has pipeline and HTTP threads running;
+    # the function is looked up by module name because scripts run as
+    # __main__ cannot be pickled by reference.
+    def __init__(self, module_name, processes=None):
+        self.module_name = module_name
+        self.executor = ProcessPoolExecutor(max_workers=processes or FLATTEN_PROCESSES,
+                                            mp_context=multiprocessing.get_context("spawn"))
+
+    def submit(self, records):
+        return self.executor.submit(flatten_to_ipc, self.module_name, records)
+
+    def shutdown(self):
+        self.executor.shutdown(cancel_futures=True)
+
+def flatten_records(module_name, records, processes=None):
+    # Whole extract at once: chunks of PAGE_SIZE records flattened in
+    # parallel and concatenated in their original order
+    processes = processes or FLATTEN_PROCESSES
+    if processes <= 1 or len(records) <= PAGE_SIZE:
+        return importlib.import_module(module_name).build_frame(records)
+    pool = ProcessFlatten(module_name, processes)
+    try:
+        futures = [pool.submit(records[offset:offset + PAGE_SIZE]) for offset in range(0, len(records), PAGE_SIZE)]
+        tables = [read_ipc(future.result()) for future in futures]
+    finally:
+        pool.shutdown()
+    return pa.concat_tables(tables, promote_options='default').to_pandas()
+
+class ParquetEncoder:
+    # Stage: DataFrame or Arrow table -> (the same, Parquet bytes of one row
+    # group). Every part is cast to the schema of the first, so the parts
+    # form one file; close() returns the footer.
+    def __init__(self, **kwargs):
+        self.sink = ChunkSink()
+        self.writer = None
+        self.kwargs = kwargs
+
+    def __call__(self, df):
+        table = df if isinstance(df, pa.Table) else pa.Table.from_pandas(df, preserve_index=False)
+        if self.writer is None:
+            self.writer = pq.ParquetWriter(self.sink, table.schema, **self.kwargs)
+        self.writer.write_table(table.cast(self.writer.schema))
+        return df, self.sink.take()
+
+    def close(self):
+        if self.writer is None:
+            return b""
+        self.writer.close()
+        return self.sink.take()
+
+class S3Stream:
+    # Stage: (frame, bytes) -> frame, appending the bytes to one S3
+    # object sent as a multipart upload of PART_SIZE parts while later parts
+    # are still being produced
+    def __init__(self, s3_url):
+        self.s3_url = s3_url
+        self.file = None
+
+    def write(self, data):
+        if self.file is None:
+            self.file = fsspec.open(self.s3_url, 'wb', block_size=PART_SIZE).open()
+        self.file.write(data)
+
+    def __call__(self, item):
+        df, data = item
+        self.write(data)
+        return df
+
+    def close(self, tail=b""):
+        if tail:
+            self.write(tail)
+        if self.file is not None:
+            self.file.close()
+
+    def discard(self):
+        # An unfinished multipart upload is aborted rather than completed
+        if self.file is None:
+            return
+        if hasattr(self.file, "discard"):
+            self.file.discard()
+        self.file.close()
+
+def incoming_url(s3_url):
+    # Beside the target under its own _incoming/ prefix: a COPY from s3_url
+    # reads everything that starts with it, so a leftover upload must not
+    directory, name = s3_url.rsplit('/', 1)
+    stem, extension = os.path.splitext(name)
+    return f"{directory}/_incoming/{stem}-{os.getpid()}{extension}"
+
+def promote(source_url, s3_url):
+    # Only a batch that passed its checks replaces the object the load reads
+    fs, source = fsspec.core.url_to_fs(source_url)
+    target = fsspec.core.url_to_fs(s3_url)[1]
+    fs.mv(source, target)
+
+def remove_incoming(url):
+    try:
+        fs, path = fsspec.core.url_to_fs(url)
+        if fs.exists(path):
+            fs.rm(path)
+    except Exception as e:
+        error_message(f"Could not remove {url}: {str(e)}")
+
+def extract_changes(session, realm_id, entity, build_frame, s3_url, flatten_module=None, validate=None, **parquet_options):
+    # fetch -> change detection and flatten -> Parquet encode -> upload, one
+    # page at a time. Records and Parquet bytes never pile up, but the frames
+    # of the changed rows are kept: they are returned as one frame (or None)
+    # for validation and the load. The upload goes to an _incoming/ key and
+    # replaces s3_url only after the row count gate and validate(frame)
+    # pass. With flatten_module (the module defining build_frame) and
+    # QB_FLATTEN_PROCESSES above 1, pages are flattened in a process pool
+    # while the next pages download.
+    counts = {}
+    changes = start_changes(entity)
+    fetched = [0]
+    pool = ProcessFlatten(flatten_module) if flatten_module and FLATTEN_PROCESSES > 1 else None
+
+    def detect(page):
+        entity_name, records = page
+        fetched[0] += len(records)
+        return track_changes(changes, records)
+
+    def flatten(page):
+        changed = detect(page)
+        return build_frame(changed) if changed else None
+
+    def submit(page):
+        changed = detect(page)
+        return pool.submit(changed) if changed else None
+
+    def collect(future):
+        return read_ipc(future.result())
+
+    # Submitted futures queue up in page order; waiting on them in that order
+    # keeps the output in page order with every worker busy
+    stages = [flatten] if pool is None else [submit, collect]
+
+    encoder = ParquetEncoder(**parquet_options)
+    incoming = incoming_url(s3_url)
+    upload = S3Stream(incoming)
+    try:
+        frames = run_pipeline(iter_entity_pages(session, realm_id, [entity], counts=counts), *stages, encoder, upload,
+                              depth=max(QUEUE_DEPTH, FLATTEN_PROCESSES) if pool else None)
+        upload.close(encoder.close())
+    except Exception:
+        upload.discard()
+        raise
+    finally:
+        if pool is not None:
+            pool.shutdown()
+    try:
+        gate(f"{entity} extract", check_row_count(entity, fetched[0], counts.get(entity)))
+        finish_changes(changes)
+        if not frames:
+            return changes, None
+        if pool is not None:
+            df = pa.concat_tables(frames, promote_options='default').to_pandas()
+        else:
+            df = pd.concat(frames, ignore_index=True)
+        del frames
+        if validate is not None:
+            validate(df)
+        promote(incoming, s3_url)
+    finally:
+        remove_incoming(incoming)
+    debug_message(f"{entity}: {len(df)} rows streamed to {s3_url}")
+    return changes, df
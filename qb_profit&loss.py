@@ -7,6 +7,16 @@ import psycopg2
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
 from dotenv import load_dotenv
+from qb_load import append_load
+from qb_ddl import frame_spec
+from qb_sinks import mirror
+from qb_ratelimit import limited_request
+from qb_report_stream import iter_report
+from qb_common import S3_PREFIX, load_credentials
+from qb_s3 import write_parquet, swap_if_changed
+from qb_coordinator import submit_load
+from qb_query import get_session
+from qb_dimensions import refresh_dimensions, cached_records
 
 def execute_sql(sql_query):
     try:
@@ -50,112 +60,197 @@ headers_report = {
 start_date = datetime(2024, 1, 1)  # Adjust the starting month/year as needed
 end_date = datetime.now()  # Adjust the ending month/year as needed
 
-# Loop through each month
-current_date = start_date
-while current_date <= end_date:
-    month_start = current_date.strftime('%Y-%m-%d')
-    month_end = (current_date + relativedelta(day=31)).strftime('%Y-%m-%d')
-    month_str = current_date.strftime('%Y-%m')  # YYYY-MM format for the month column
+# QB_PNL_MODE=wide asks for the whole range in one request, one column per
+# month (summarize_column_by=Month), and unpivots it into long rows in
+# finance.qb_profit_and_loss_long. QB_PNL_DIMENSION=Class or Department adds
+# one request per class or department, filtered to it; the unfiltered
+# company-wide rows always come first, with an empty dimension.
+DIMENSION_PARAMS = {"Class": "class", "Department": "department"}
 
-    # Query parameters for the month
+# Checked before any request is made; any letter case is accepted
+dimension_setting = os.getenv("QB_PNL_DIMENSION", "").strip()
+pnl_dimension = next((name for name in DIMENSION_PARAMS if name.lower() == dimension_setting.lower()), None) if dimension_setting else ""
+if pnl_dimension is None:
+    print(f"Error: QB_PNL_DIMENSION must be {' or '.join(DIMENSION_PARAMS)} (or unset), not '{dimension_setting}'.")
+    raise SystemExit(1)
+
+def month_columns(columns):
+    # Column index -> 'Mon,YYYY'; the account and Total columns carry no StartDate
+    months = {}
+    for index, column in enumerate(columns.get('Column', [])):
+        meta_data = {item.get('Name'): item.get('Value') for item in column.get('MetaData', [])}
+        if 'StartDate' in meta_data:
+            months[index] = datetime.strptime(meta_data['StartDate'], '%Y-%m-%d').strftime('%b,%Y')
+    return months
+
+def wide_rows(response):
+    # One [path, row_type, col 0, col 1, ...] list per data or summary row;
+    # path keeps the section hierarchy above the row
+    months = {}
+    rows = []
+
+    def walk(row, path):
+        if 'Header' in row:
+            section = row['Header']['ColData'][0].get('value', '')
+            sub_path = f"{path} -> {section}" if path else section
+            for sub_row in row.get('Rows', {}).get('Row', []):
+                walk(sub_row, sub_path)
+            if 'Summary' in row:
+                rows.append([sub_path, 'Summary'] + [col.get('value', '') for col in row['Summary']['ColData']])
+        elif 'ColData' in row:
+            rows.append([path, 'Data'] + [col.get('value', '') for col in row['ColData']])
+        elif 'Summary' in row:
+            rows.append([path, 'Summary'] + [col.get('value', '') for col in row['Summary']['ColData']])
+
+    for section, item in iter_report(response):
+        if section == 'Columns':
+            months = month_columns(item)
+        elif section == 'Row':
+            walk(item, '')
+    return months, rows
+
+def unpivot(months, rows, dimension):
+    wide = pd.DataFrame(rows)
+    wide = wide.rename(columns={0: 'path', 1: 'row_type', 2: 'category', **{index + 2: month for index, month in months.items()}})
+    long = wide.melt(id_vars=['path', 'row_type', 'category'], value_vars=list(months.values()), var_name='month', value_name='amount')
+    long['amount'] = pd.to_numeric(long['amount'], errors='coerce').fillna(0).astype(float)
+    long['category'] = long['category'].fillna('')
+    long['dimension'] = dimension
+    return long[['category', 'path', 'row_type', 'month', 'dimension', 'amount']]
+
+def extract_wide():
     params = {
-        "start_date": month_start,
-        "end_date": month_end
+        "start_date": start_date.strftime('%Y-%m-%d'),
+        "end_date": end_date.strftime('%Y-%m-%d'),
+        "summarize_column_by": "Month"
     }
+    requested = [('', {})]
+    dimension = pnl_dimension
+    if dimension:
+        # Class and Department lists come from the dimension cache, refreshed incrementally
+        credentials = load_credentials()
+        if credentials is None:
+            return
+        refresh_dimensions(get_session(credentials), credentials["realm_id"], [dimension])
+        requested += [(record.get('Name', ''), {DIMENSION_PARAMS[dimension]: record['Id']}) for record in cached_records(dimension)]
+
+    frames = []
+    for name, dimension_params in requested:
+        response_report = limited_request(requests, "GET", url_report, realm_id, "report", headers=headers_report,
+                                          params={**params, **dimension_params}, stream=True)
+        if response_report.status_code != 200:
+            print(f"Error: {response_report.status_code}, {response_report.text}")
+            return
+        months, rows = wide_rows(response_report)
+        if rows and months:
+            frames.append(unpivot(months, rows, name))
+        print(f"API request successful for {name or 'all'}: {len(rows)} rows x {len(months)} months.")
+    if not frames:
+        print("The ProfitAndLoss report returned no rows.")
+        return
+
+    df = pd.concat(frames, ignore_index=True)
+    table = 'finance.qb_profit_and_loss_long'
+    s3_url = f'{S3_PREFIX}/profit_and_loss_long.parquet'
+    digest = write_parquet(df, s3_url)
+    print(f"{len(df)} rows saved to Parquet file: {s3_url}")
+
+    # Every month of the range is in the file, so it replaces the table in one swap
+    submit_load(table, swap_if_changed, table, s3_url, digest, frame_spec(df, diststyle='ALL'), df)
+
+if os.getenv("QB_PNL_MODE", "monthly").lower() == "wide":
+    extract_wide()
+else:
+    # Loop through each month
+    current_date = start_date
+    while current_date <= end_date:
+        month_start = current_date.strftime('%Y-%m-%d')
+        month_end = (current_date + relativedelta(day=31)).strftime('%Y-%m-%d')
+        month_str = current_date.strftime('%Y-%m')  # YYYY-MM format for the month column
+
+        # Query parameters for the month
+        params = {
+            "start_date": month_start,
+            "end_date": month_end
+        }
+
+        # Make the request to fetch report data; the body is streamed, not loaded whole
+        response_report = limited_request(requests, "GET", url_report, realm_id, "report", headers=headers_report, params=params, stream=True)
+
+        if response_report.status_code == 200:
+            print(f"API request successful for {month_str}. Status code: {response_report.status_code}")
+
+            def process_json(response):
+                data = []
+
+                def process_row(row, account_path):
+                    if 'Header' in row:
+                        header = row['Header']['ColData']
+                        account = header[0]['value'] if len(header) > 0 else ''
+                        total = header[1]['value'] if len(header) > 1 else ''
+                        data.append([account_path, account, total])
+
+                    if 'Rows' in row:
+                        for sub_row in row['Rows']['Row']:
+                            sub_account_path = account_path + ' -> ' + row['Header']['ColData'][0]['value']
+                            process_row(sub_row, sub_account_path)
+
+                    if 'ColData' in row:
+                        col_data = row['ColData']
+                        account = col_data[0]['value'] if len(col_data) > 0 else ''
+                        total = col_data[1]['value'] if len(col_data) > 1 else ''
+                        data.append([account_path, account, total])
+
+                    if 'Summary' in row:
+                        summary = row['Summary']['ColData']
+                        account = summary[0]['value'] if len(summary) > 0 else ''
+                        total = summary[1]['value'] if len(summary) > 1 else ''
+                        data.append([account_path + ' (Summary)', account, total])
+
+                # Each top-level section is processed as soon as it has been read
+                for section, row in iter_report(response):
+                    if section == 'Row':
+                        process_row(row, '')
+
+                return data
+
+            # Convert JSON data to DataFrame
+            data = process_json(response_report)
+            df = pd.DataFrame(data, columns=['Path', 'Account', 'Total'])
+
+            # Clean up the DataFrame
+            df['Total'] = pd.to_numeric(df['Total'], errors='coerce').fillna(0)  # Ensure numeric amounts in Total 
+            df['Account'] = df['Account'].replace('', pd.NA)  # Replace empty strings with NaN 
+            df.fillna(0, inplace=True)  # Replace NaN with 0 for saving to Parquet
+            df=df.drop(columns=['Path'])
+
+            # Rename columns to match Redshift table
+            df = df.rename(columns={'Account': 'category', 'Total': 'total_amount'})
+
+            # Add month column (since it's missing in the data), already in the 'Mon,YYYY' form of the final table
+            df['month'] = current_date.strftime('%b,%Y')
+
+            # Ensure 'Total' is of type float for Parquet
+            df['total_amount'] = df['total_amount'].astype(float)
+
+            # Save to CSV file
+            df.to_csv('p&lnewest.csv', index=False)
+            print(df)
+
+            # Save DataFrame to Parquet file
+            s3_url = f's3://datalake-medusadistribution/datalake/to_redshift/qb/profit_and_loss_{month_str}.parquet'
+            try:
+                df.to_parquet(s3_url, index=False, engine='pyarrow')
+                print(f"DataFrame for {month_str} successfully saved to Parquet file: {s3_url}")
+            except Exception as e:
+                print(f"An error occurred while saving DataFrame for {month_str} to Parquet file: {str(e)}")
+
+            # Months are only ever added, so move the staged rows in with ALTER TABLE APPEND
+            if append_load('finance.qb_profit_and_loss', s3_url, spec=frame_spec(df, diststyle='ALL')):
+                mirror('append', 'finance.qb_profit_and_loss', df)
+
+        else:
+            print(f"Error: {response_report.status_code}, {response_report.text}")
 
-    # Make the request to fetch report data
-    response_report = requests.get(url_report, headers=headers_report, params=params)
-
-    if response_report.status_code == 200:
-        print(f"API request successful for {month_str}. Status code: {response_report.status_code}")
-        report_data = response_report.json()
-
-        def process_json(json_data):
-            data = []
-
-            def process_row(row, account_path):
-                if 'Header' in row:
-                    header = row['Header']['ColData']
-                    account = header[0]['value'] if len(header) > 0 else ''
-                    total = header[1]['value'] if len(header) > 1 else ''
-                    data.append([account_path, account, total])
-
-                if 'Rows' in row:
-                    for sub_row in row['Rows']['Row']:
-                        sub_account_path = account_path + ' -> ' + row['Header']['ColData'][0]['value']
-                        process_row(sub_row, sub_account_path)
-
-                if 'ColData' in row:
-                    col_data = row['ColData']
-                    account = col_data[0]['value'] if len(col_data) > 0 else ''
-                    total = col_data[1]['value'] if len(col_data) > 1 else ''
-                    data.append([account_path, account, total])
-
-                if 'Summary' in row:
-                    summary = row['Summary']['ColData']
-                    account = summary[0]['value'] if len(summary) > 0 else ''
-                    total = summary[1]['value'] if len(summary) > 1 else ''
-                    data.append([account_path + ' (Summary)', account, total])
-
-            for row in json_data['Rows']['Row']:
-                process_row(row, '')
-
-            return data
-
-        # Convert JSON data to DataFrame
-        data = process_json(report_data)
-        df = pd.DataFrame(data, columns=['Path', 'Account', 'Total'])
-
-        # Clean up the DataFrame
-        df['Total'] = pd.to_numeric(df['Total'], errors='coerce').fillna(0)  # Ensure numeric amounts in Total 
-        df['Account'] = df['Account'].replace('', pd.NA)  # Replace empty strings with NaN 
-        df.fillna(0, inplace=True)  # Replace NaN with 0 for saving to Parquet
-        df=df.drop(columns=['Path'])
-
-        # Rename columns to match Redshift table
-        df = df.rename(columns={'Account': 'category', 'Total': 'total_amount'})
-
-        # Add month column (since it's missing in the data)
-        df['month'] = month_str
-
-        # Ensure 'Total' is of type float for Parquet
-        df['total_amount'] = df['total_amount'].astype(float)
-
-        # Save to CSV file
-        df.to_csv('p&lnewest.csv', index=False)
-        print(df)
-
-        # Save DataFrame to Parquet file
-        s3_url = f's3://datalake-medusadistribution/datalake/to_redshift/qb/profit_and_loss_{month_str}.parquet'
-        try:
-            df.to_parquet(s3_url, index=False, engine='pyarrow')
-            print(f"DataFrame for {month_str} successfully saved to Parquet file: {s3_url}")
-        except Exception as e:
-            print(f"An error occurred while saving DataFrame for {month_str} to Parquet file: {str(e)}")
-
-        # Define SQL statements
-        sql_statements = [
-            """CREATE TABLE IF NOT EXISTS finance.temp_qb_profit_and_loss(
-                  category          VARCHAR(255),
-                  total_amount      DOUBLE PRECISION,
-                  month             VARCHAR(255)
-               );""",
-            f"COPY finance.temp_qb_profit_and_loss FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-            """INSERT INTO finance.qb_profit_and_loss
-                       SELECT 
-                            category,
-                            total_amount,
-                            TO_CHAR(TO_DATE(month, 'YYYY-MM'), 'Mon,YYYY') AS month
-                       FROM finance.temp_qb_profit_and_loss;""",
-            """DROP TABLE finance.temp_qb_profit_and_loss;"""
-        ]
-
-        for sql in sql_statements:
-            print(f"Executing SQL statement: {sql}")
-            execute_sql(sql)
-
-    else:
-        print(f"Error: {response_report.status_code}, {response_report.text}")
-
-    # Move to the next month
-    current_date += relativedelta(months=1)
+        # Move to the next month
+        current_date += relativedelta(months=1)
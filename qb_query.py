@@ -0,0 +1,147 @@
+#!/usr/bin/env python
+
+import requests
+from qb_common import debug_message, WARM
+from qb_decode import decode_query_response, decode_batch_response
+from qb_ratelimit import limited_request
+
+BASE_URL = "https://quickbooks.api.intuit.com/v3/company"
+
+# QuickBooks caps a query page at 1000 rows and a batch request at 30 operations
+PAGE_SIZE = 1000
+BATCH_LIMIT = 30
+
+class QuickBooksAPIError(Exception):
+    pass
+
+# Sessions kept open between runs in daemon mode, keyed by access token so a
+# refreshed token gets a fresh session
+SESSIONS = {}
+
+def get_session(credentials):
+    if WARM["enabled"] and credentials['access_token'] in SESSIONS:
+        return SESSIONS[credentials['access_token']]
+    session = requests.Session()
+    session.headers.update({
+        "Authorization": f"Bearer {credentials['access_token']}",
+        "Accept": "application/json",
+    })
+    if WARM["enabled"]:
+        for stale in SESSIONS.values():
+            stale.close()
+        SESSIONS.clear()
+        SESSIONS[credentials['access_token']] = session
+    return session
+
+def build_select(entity, where=None, start_position=None, max_results=None):
+    statement = f"SELECT * FROM {entity}"
+    if where:
+        statement += f" WHERE {where}"
+    if start_position is not None:
+        # Pages of an unordered query may overlap or skip records
+        statement += f" ORDERBY Id STARTPOSITION {start_position}"
+    if max_results is not None:
+        statement += f" MAXRESULTS {max_results}"
+    return statement
+
+def build_count(entity, where=None):
+    statement = f"SELECT COUNT(*) FROM {entity}"
+    if where:
+        statement += f" WHERE {where}"
+    return statement
+
+def run_query(session, realm_id, statement):
+    url_query = f"{BASE_URL}/{realm_id}/query"
+    response_query = limited_request(session, "GET", url_query, realm_id, "query",
+                                     params={"query": statement}, headers={"Content-Type": "text/plain"})
+    if response_query.status_code != 200:
+        raise QuickBooksAPIError(f"Query failed with status code {response_query.status_code}: {response_query.text}")
+    return decode_query_response(response_query.content)
+
+def iter_batch(session, realm_id, statements):
+    # Pack independent queries into /batch calls of up to BATCH_LIMIT operations
+    # and yield one QueryResponse per statement, in the original order, as
+    # soon as the call that carried it has returned
+    url_batch = f"{BASE_URL}/{realm_id}/batch"
+    for offset in range(0, len(statements), BATCH_LIMIT):
+        chunk = statements[offset:offset + BATCH_LIMIT]
+        if len(chunk) == 1:
+            yield run_query(session, realm_id, chunk[0])
+            continue
+        payload = {
+            "BatchItemRequest": [
+                {"bId": str(offset + i), "Query": statement}
+                for i, statement in enumerate(chunk)
+            ]
+        }
+        response_batch = limited_request(session, "POST", url_batch, realm_id, "batch",
+                                         json=payload, headers={"Content-Type": "application/json"})
+        if response_batch.status_code != 200:
+            raise QuickBooksAPIError(f"Batch failed with status code {response_batch.status_code}: {response_batch.text}")
+        items = {item.get("bId"): item for item in decode_batch_response(response_batch.content)}
+        results = []
+        for i, statement in enumerate(chunk):
+            item = items.get(str(offset + i))
+            if item is None:
+                raise QuickBooksAPIError(f"Batch response is missing the result for: {statement}")
+            if "Fault" in item:
+                raise QuickBooksAPIError(f"Batch operation failed for {statement}: {item['Fault']}")
+            results.append(item.get("QueryResponse", {}))
+        debug_message(f"Batch of {len(chunk)} queries completed.")
+        yield from results
+
+def run_batch(session, realm_id, statements):
+    return list(iter_batch(session, realm_id, statements))
+
+def where_for(entity, where):
+    # A single clause applies to every entity; a dict gives each entity its own
+    return where.get(entity) if isinstance(where, dict) else where
+
+def count_entities(session, realm_id, entities, where=None):
+    statements = [build_count(entity, where_for(entity, where)) for entity in entities]
+    responses = run_batch(session, realm_id, statements)
+    return {entity: response.get("totalCount", 0) for entity, response in zip(entities, responses)}
+
+def iter_entity_pages(session, realm_id, entities, where=None, counts=None):
+    # One batch of COUNT probes sizes every entity, then all page windows of
+    # all entities are packed together into as few batch calls as possible.
+    # Pages are yielded as (entity, records) while later batches are still to
+    # be requested. Pass a dict as counts to get the probed totals back.
+    probed = count_entities(session, realm_id, entities, where)
+    if counts is not None:
+        counts.update(probed)
+    windows = []
+    for entity in entities:
+        for start_position in range(1, probed[entity] + 1, PAGE_SIZE):
+            windows.append((entity, start_position))
+
+    statements = [build_select(entity, where_for(entity, where), start_position, PAGE_SIZE) for entity, start_position in windows]
+    fetched = {entity: 0 for entity in entities}
+    last_page = {}
+    for (entity, start_position), response in zip(windows, iter_batch(session, realm_id, statements)):
+        records = response.get(entity, [])
+        fetched[entity] += len(records)
+        last_page[entity] = (start_position, len(records))
+        yield entity, records
+
+    # Rows created after the COUNT probe land past the last window, so keep
+    # reading sequentially while the final page comes back full
+    for entity in entities:
+        start_position, page_length = last_page.get(entity, (1 - PAGE_SIZE, PAGE_SIZE))
+        while page_length == PAGE_SIZE:
+            start_position += PAGE_SIZE
+            response = run_query(session, realm_id, build_select(entity, where_for(entity, where), start_position, PAGE_SIZE))
+            records = response.get(entity, [])
+            fetched[entity] += len(records)
+            page_length = len(records)
+            yield entity, records
+        debug_message(f"Fetched {fetched[entity]} {entity} records.")
+
+def fetch_entities(session, realm_id, entities, where=None, counts=None):
+    all_data = {entity: [] for entity in entities}
+    for entity, records in iter_entity_pages(session, realm_id, entities, where, counts):
+        all_data[entity].extend(records)
+    return all_data
+
+def fetch_entity(session, realm_id, entity, where=None, counts=None):
+    return fetch_entities(session, realm_id, [entity], where, counts)[entity]
@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+
+import os
+import time
+import random
+import sqlite3
+from qb_common import debug_message
+
+# Shared by every process on the host through one SQLite file: a token bucket
+# per realm and endpoint class for requests per minute, and a per-realm cap on
+# requests in flight. The cap adapts: it is halved on a 429, lowered by one on
+# a slow response and grows by one after a full window of fast successes.
+LIMIT_PATH = os.getenv("QB_RATE_LIMIT_DB", "/home/sameen/qb_scripts/qb_rate_limit.sqlite")
+
+# QuickBooks allows 500 requests per minute and 10 concurrent requests per
+# realm, and 40 batch requests per minute; a little headroom is kept
+RATES_PER_MINUTE = {
+    "request": int(os.getenv("QB_REQUESTS_PER_MINUTE", "450")),
+    "batch": int(os.getenv("QB_BATCHES_PER_MINUTE", "36"))
+}
+MAX_CONCURRENCY = int(os.getenv("QB_MAX_CONCURRENCY", "8"))
+SLOW_RESPONSE_SECONDS = float(os.getenv("QB_SLOW_RESPONSE_SECONDS", "20"))
+
+# A lease left by a crashed process stops counting after this long
+LEASE_SECONDS = 600
+MAX_WAIT_SECONDS = 2.0
+RETRIES = 5
+
+def open_limiter(path=None):
+    conn = sqlite3.connect(path or LIMIT_PATH, timeout=30, isolation_level=None)
+    conn.execute("""CREATE TABLE IF NOT EXISTS bucket (
+        realm_id TEXT NOT NULL,
+        name TEXT NOT NULL,
+        tokens REAL NOT NULL,
+        updated REAL NOT NULL,
+        PRIMARY KEY (realm_id, name)
+    ) WITHOUT ROWID;""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS concurrency (
+        realm_id TEXT PRIMARY KEY,
+        concurrency_limit INTEGER NOT NULL,
+        successes INTEGER NOT NULL
+    ) WITHOUT ROWID;""")
+    conn.execute("""CREATE TABLE IF NOT EXISTS lease (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        realm_id TEXT NOT NULL,
+        pid INTEGER NOT NULL,
+        expires REAL NOT NULL
+    );""")
+    return conn
+
+def bucket_name(kind):
+    return "batch" if kind == "batch" else "request"
+
+def try_acquire(conn, realm_id, kind, now):
+    # Returns (lease id, None) or (None, seconds to wait); runs inside BEGIN IMMEDIATE
+    name = bucket_name(kind)
+    rate = RATES_PER_MINUTE[name] / 60.0
+    capacity = float(RATES_PER_MINUTE[name])
+    conn.execute("DELETE FROM lease WHERE expires < ?;", (now,))
+    conn.execute("INSERT OR IGNORE INTO bucket (realm_id, name, tokens, updated) VALUES (?, ?, ?, ?);", (realm_id, name, capacity, now))
+    conn.execute("INSERT OR IGNORE INTO concurrency (realm_id, concurrency_limit, successes) VALUES (?, ?, 0);", (realm_id, MAX_CONCURRENCY))
+
+    tokens, updated = conn.execute("SELECT tokens, updated FROM bucket WHERE realm_id = ? AND name = ?;", (realm_id, name)).fetchone()
+    tokens = min(capacity, tokens + (now - updated) * rate)
+    limit = conn.execute("SELECT concurrency_limit FROM concurrency WHERE realm_id = ?;", (realm_id,)).fetchone()[0]
+    in_flight = conn.execute("SELECT COUNT(*) FROM lease WHERE realm_id = ?;", (realm_id,)).fetchone()[0]
+
+    if tokens >= 1 and in_flight < limit:
+        conn.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE realm_id = ? AND name = ?;", (tokens - 1, now, realm_id, name))
+        cursor = conn.execute("INSERT INTO lease (realm_id, pid, expires) VALUES (?, ?, ?);", (realm_id, os.getpid(), now + LEASE_SECONDS))
+        return cursor.lastrowid, None
+    conn.execute("UPDATE bucket SET tokens = ?, updated = ? WHERE realm_id = ? AND name = ?;", (tokens, now, realm_id, name))
+    wait = (1 - tokens) / rate if tokens < 1 else 0.1
+    return None, min(MAX_WAIT_SECONDS, wait)
+
+def acquire(realm_id, kind):
+    while True:
+        conn = open_limiter()
+        try:
+            conn.execute("BEGIN IMMEDIATE;")
+            lease_id, wait = try_acquire(conn, realm_id, kind, time.time())
+            conn.execute("COMMIT;")
+        finally:
+            conn.close()
+        if lease_id is not None:
+            return lease_id
+        # Jitter keeps waiting processes from waking up in lockstep
+        time.sleep(wait * random.uniform(0.8, 1.2))
+
+def release(realm_id, lease_id, status_code, elapsed):
+    conn = open_limiter()
+    try:
+        conn.execute("BEGIN IMMEDIATE;")
+        conn.execute("DELETE FROM lease WHERE id = ?;", (lease_id,))
+        limit, successes = conn.execute("SELECT concurrency_limit, successes FROM concurrency WHERE realm_id = ?;", (realm_id,)).fetchone()
+        if status_code == 429:
+            new_limit, successes = max(1, limit // 2), 0
+            # Empty the bucket so every process backs off, not just this one
+            conn.execute("UPDATE bucket SET tokens = 0, updated = ? WHERE realm_id = ?;", (time.time(), realm_id))
+        elif elapsed > SLOW_RESPONSE_SECONDS:
+            new_limit, successes = max(1, limit - 1), 0
+        elif status_code is not None and status_code < 500:
+            successes += 1
+            new_limit = limit
+            if successes >= limit and limit < MAX_CONCURRENCY:
+                new_limit, successes = limit + 1, 0
+        else:
+            new_limit = limit
+        conn.execute("UPDATE concurrency SET concurrency_limit = ?, successes = ? WHERE realm_id = ?;", (new_limit, successes, realm_id))
+        conn.execute("COMMIT;")
+    finally:
+        conn.close()
+    if new_limit != limit:
+        debug_message(f"QuickBooks concurrency for realm {realm_id}: {limit} -> {new_limit}")
+
+class ApiSlot:
+    # with ApiSlot(realm_id, 'query') as slot: ... slot.record(response.status_code)
+    # The slot is held until the block exits, so a streamed report body counts
+    # as in flight until it has been read.
+
+    def __init__(self, realm_id, kind):
+        self.realm_id = str(realm_id)
+        self.kind = kind
+        self.status_code = None
+
+    def record(self, status_code):
+        self.status_code = status_code
+        self.elapsed = time.monotonic() - self.started
+
+    def __enter__(self):
+        self.lease_id = acquire(self.realm_id, self.kind)
+        self.started = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        if self.status_code is None:
+            self.elapsed = time.monotonic() - self.started
+        release(self.realm_id, self.lease_id, self.status_code, self.elapsed)
+        return False
+
+def retry_after(response, attempt):
+    try:
+        return float(response.headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return min(60, 2 ** attempt) * random.uniform(0.5, 1.0)
+
+def limited_request(session, method, url, realm_id, kind, **kwargs):
+    # Non-streamed request through the shared limiter; 429s are retried after
+    # Retry-After (or a jittered backoff) and every other response is returned
+    for attempt in range(1, RETRIES + 1):
+        with ApiSlot(realm_id, kind) as slot:
+            response = session.request(method, url, **kwargs)
+            slot.record(response.status_code)
+        if response.status_code != 429:
+            return response
+        debug_message(f"QuickBooks throttled the {kind} request (attempt {attempt}/{RETRIES}).")
+        time.sleep(retry_after(response, attempt))
+    return response
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# Report responses are read incrementally: Header and Columns are built as
+# small objects, and each top-level Rows.Row entry is handed over as soon as it
+# is complete, so the whole report tree never exists in memory at once.
+# Without ijson installed the body is decoded in one go and replayed the same way.
+ROW_PREFIX = 'Rows.Row.item'
+
+def iter_report(response):
+    # Yields ('Header', dict), ('Columns', dict) and ('Row', dict) in document
+    # order; the response must come from a request made with stream=True
+    if ijson is None:
+        report_data = response.json()
+        for name in ('Header', 'Columns'):
+            if name in report_data:
+                yield name, report_data[name]
+        for row in report_data.get('Rows', {}).get('Row', []):
+            yield 'Row', row
+        return
+
+    response.raw.decode_content = True
+    builder = None
+    target = None
+    for prefix, event, value in ijson.parse(response.raw):
+        if builder is None:
+            if event != 'start_map' or prefix not in ('Header', 'Columns', ROW_PREFIX):
+                continue
+            builder = ijson.ObjectBuilder()
+            target = prefix
+        builder.event(event, value)
+        if event == 'end_map' and prefix == target:
+            yield ('Row' if target == ROW_PREFIX else target), builder.value
+            builder = None
+
+def column_titles(columns):
+    return [col.get('ColTitle') for col in columns.get('Column', [])]
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+
+import os
+import hashlib
+import sqlite3
+import tempfile
+import fsspec
+from qb_common import debug_message
+from qb_change_index import full_refresh_requested
+from qb_load import swap_load
+from qb_sinks import mirror
+
+try:
+    import boto3
+    from boto3.s3.transfer import TransferConfig
+except ImportError:
+    boto3 = None
+
+# Outputs are serialized locally first and identified by a content hash. An
+# object identical to the last upload is not uploaded again, and an object
+# identical to the last successful load is not loaded again.
+STATE_PATH = os.getenv("QB_WRITE_STATE", "/home/sameen/qb_scripts/qb_writes.sqlite")
+
+# Files above one part are sent as concurrent multipart uploads
+PART_SIZE = int(os.getenv("QB_S3_PART_SIZE_MB", "16")) * 1024 * 1024
+UPLOAD_THREADS = int(os.getenv("QB_S3_UPLOAD_THREADS", "8"))
+
+# Serialized output stays in memory up to this size, then spills to disk
+SPOOL_SIZE = 64 * 1024 * 1024
+HASH_CHUNK = 1024 * 1024
+
+CLIENT = {}
+
+def open_state(path=None):
+    conn = sqlite3.connect(path or STATE_PATH)
+    conn.execute("""CREATE TABLE IF NOT EXISTS output (
+        s3_url TEXT PRIMARY KEY,
+        uploaded_digest TEXT,
+        loaded_digest TEXT
+    ) WITHOUT ROWID;""")
+    return conn
+
+def stored_digests(s3_url):
+    conn = open_state()
+    try:
+        row = conn.execute("SELECT uploaded_digest, loaded_digest FROM output WHERE s3_url = ?;", (s3_url,)).fetchone()
+    finally:
+        conn.close()
+    return row or (None, None)
+
+def store_digest(s3_url, column, digest):
+    conn = open_state()
+    try:
+        with conn:
+            conn.execute("INSERT OR IGNORE INTO output (s3_url) VALUES (?);", (s3_url,))
+            conn.execute(f"UPDATE output SET {column} = ? WHERE s3_url = ?;", (digest, s3_url))
+    finally:
+        conn.close()
+
+def spool():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE)
+
+def file_digest(fileobj):
+    fileobj.seek(0)
+    digest = hashlib.blake2b(digest_size=16)
+    for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b""):
+        digest.update(chunk)
+    fileobj.seek(0)
+    return digest.hexdigest()
+
+def s3_client():
+    if "s3" not in CLIENT:
+        CLIENT["s3"] = boto3.client("s3")
+    return CLIENT["s3"]
+
+def upload(fileobj, s3_url):
+    fileobj.seek(0)
+    if boto3 is None or not s3_url.startswith("s3://"):
+        with fsspec.open(s3_url, 'wb') as sink:
+            for chunk in iter(lambda: fileobj.read(HASH_CHUNK), b""):
+                sink.write(chunk)
+        return
+    bucket, key = s3_url[len("s3://"):].split('/', 1)
+    config = TransferConfig(multipart_threshold=PART_SIZE, multipart_chunksize=PART_SIZE, max_concurrency=UPLOAD_THREADS)
+    s3_client().upload_fileobj(fileobj, bucket, key, Config=config)
+
+def publish(fileobj, s3_url):
+    # Returns the content digest; the upload is skipped when S3 already holds it
+    digest = file_digest(fileobj)
+    if stored_digests(s3_url)[0] == digest:
+        debug_message(f"{s3_url} is unchanged; skipping upload.")
+        return digest
+    upload(fileobj, s3_url)
+    store_digest(s3_url, "uploaded_digest", digest)
+    return digest
+
+def write_parquet(df, s3_url, **kwargs):
+    with spool() as buffer:
+        df.to_parquet(buffer, index=False, engine='pyarrow', **kwargs)
+        return publish(buffer, s3_url)
+
+def is_loaded(s3_url, digest):
+    if full_refresh_requested():
+        return False
+    return stored_digests(s3_url)[1] == digest
+
+def mark_loaded(s3_url, digest):
+    store_digest(s3_url, "loaded_digest", digest)
+
+def swap_if_changed(table, s3_url, digest, spec, data=None):
+    # Full-refresh load of a published file: skipped when the last successful
+    # load used the same content, remembered once loaded, then mirrored
+    if is_loaded(s3_url, digest):
+        debug_message(f"{table} is unchanged since the last load; skipping Redshift.")
+        return True
+    if not swap_load(table, s3_url, spec=spec):
+        return False
+    mark_loaded(s3_url, digest)
+    if data is not None:
+        mirror('replace', table, data)
+    return True
@@ -0,0 +1,170 @@
+#!/usr/bin/env python
+
+import os
+import glob
+import shutil
+import datetime
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from qb_common import debug_message, error_message
+
+try:
+    import duckdb
+except ImportError:
+    duckdb = None
+
+# Local mirrors fed with the same frames that go to S3 and Redshift, kept in
+# step with the same replace / merge / append semantics. QB_LOCAL_SINKS lists
+# the mirrors to maintain: "duckdb", "parquet" or both. A mirror that fails
+# is reported and skipped; it never fails the Redshift load.
+DUCKDB_PATH = os.getenv("QB_MIRROR_DUCKDB", "/home/sameen/qb_scripts/qb_mirror.duckdb")
+PARQUET_DIR = os.getenv("QB_MIRROR_DIR", "/home/sameen/qb_scripts/mirror")
+
+def plain_type(arrow_type):
+    return arrow_type.value_type if pa.types.is_dictionary(arrow_type) else arrow_type
+
+def to_arrow(data):
+    # DataFrames, Arrow tables or a RecordBatchReader; dictionary columns are
+    # decoded so every batch appends to the same plain column types
+    if data is None:
+        return None
+    if isinstance(data, pa.RecordBatchReader):
+        schema = pa.schema([(field.name, plain_type(field.type)) for field in data.schema])
+        return pa.RecordBatchReader.from_batches(schema, (batch.cast(schema) for batch in data))
+    if not isinstance(data, pa.Table):
+        data = pa.Table.from_pandas(data, preserve_index=False)
+    schema = pa.schema([(field.name, plain_type(field.type)) for field in data.schema])
+    return data.cast(schema)
+
+class DuckDBSink:
+
+    def __init__(self, path=None):
+        self.path = path or DUCKDB_PATH
+
+    def connect(self, table):
+        conn = duckdb.connect(self.path)
+        conn.execute(f"CREATE SCHEMA IF NOT EXISTS {table.split('.')[0]};")
+        return conn
+
+    def exists(self, conn, table):
+        schema, name = table.split('.')
+        return conn.execute(
+            "SELECT COUNT(*) FROM information_schema.tables WHERE table_schema = ? AND table_name = ?;",
+            [schema, name]).fetchone()[0] > 0
+
+    def replace(self, table, data):
+        conn = self.connect(table)
+        try:
+            conn.register("incoming", data)
+            conn.execute(f"CREATE OR REPLACE TABLE {table} AS SELECT * FROM incoming;")
+        finally:
+            conn.close()
+
+    def merge(self, table, data, key='id', deleted_ids=()):
+        conn = self.connect(table)
+        try:
+            conn.execute("BEGIN TRANSACTION;")
+            if data is not None:
+                conn.register("incoming", data)
+                if not self.exists(conn, table):
+                    conn.execute(f"CREATE TABLE {table} AS SELECT * FROM incoming LIMIT 0;")
+                conn.execute(f"DELETE FROM {table} WHERE {key} IN (SELECT {key} FROM incoming);")
+            if deleted_ids and self.exists(conn, table):
+                conn.execute(f"DELETE FROM {table} WHERE CAST({key} AS VARCHAR) IN (SELECT unnest(?::VARCHAR[]));",
+                             [[str(record_id) for record_id in deleted_ids]])
+            if data is not None:
+                conn.execute(f"INSERT INTO {table} BY NAME SELECT * FROM incoming;")
+            conn.execute("COMMIT;")
+        finally:
+            conn.close()
+
+    def append(self, table, data):
+        conn = self.connect(table)
+        try:
+            conn.register("incoming", data)
+            if self.exists(conn, table):
+                conn.execute(f"INSERT INTO {table} BY NAME SELECT * FROM incoming;")
+            else:
+                conn.execute(f"CREATE TABLE {table} AS SELECT * FROM incoming;")
+        finally:
+            conn.close()
+
+class ParquetDirSink:
+    # One directory per table under PARQUET_DIR/<schema>/<name>; readable with
+    # DuckDB, pandas or pyarrow.dataset without any database file
+
+    def __init__(self, root=None):
+        self.root = root or PARQUET_DIR
+
+    def table_dir(self, table):
+        return os.path.join(self.root, *table.split('.'))
+
+    def write_dir(self, directory, data):
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, f"part-{datetime.datetime.now().strftime('%Y%m%d%H%M%S%f')}.parquet")
+        if isinstance(data, pa.RecordBatchReader):
+            with pq.ParquetWriter(path, data.schema) as writer:
+                for batch in data:
+                    writer.write_batch(batch)
+        else:
+            pq.write_table(data, path)
+
+    def replace(self, table, data):
+        # Written next to the current directory, then swapped in
+        directory = self.table_dir(table)
+        incoming = directory + ".incoming"
+        retired = directory + ".retired"
+        shutil.rmtree(incoming, ignore_errors=True)
+        shutil.rmtree(retired, ignore_errors=True)
+        self.write_dir(incoming, data)
+        if os.path.isdir(directory):
+            os.rename(directory, retired)
+        os.rename(incoming, directory)
+        shutil.rmtree(retired, ignore_errors=True)
+
+    def read(self, table):
+        parts = sorted(glob.glob(os.path.join(self.table_dir(table), "*.parquet")))
+        return pa.concat_tables([pq.read_table(part) for part in parts], promote_options='default') if parts else None
+
+    def merge(self, table, data, key='id', deleted_ids=()):
+        current = self.read(table)
+        if current is None:
+            if data is not None:
+                self.replace(table, data)
+            return
+        removed = [str(record_id) for record_id in deleted_ids]
+        if data is not None:
+            removed += pc.cast(data[key], pa.string()).to_pylist()
+        kept = current.filter(pc.invert(pc.fill_null(pc.is_in(pc.cast(current[key], pa.string()), pa.array(removed, pa.string())), False)))
+        self.replace(table, kept if data is None else pa.concat_tables([kept, data], promote_options='default'))
+
+    def append(self, table, data):
+        self.write_dir(self.table_dir(table), data)
+
+SINKS = {
+    "duckdb": DuckDBSink,
+    "parquet": ParquetDirSink
+}
+
+def local_sinks():
+    sinks = []
+    for name in [name.strip() for name in os.getenv("QB_LOCAL_SINKS", "").split(",") if name.strip()]:
+        if name not in SINKS:
+            error_message(f"Unknown sink in QB_LOCAL_SINKS: {name}")
+        elif name == "duckdb" and duckdb is None:
+            error_message("QB_LOCAL_SINKS includes duckdb but the duckdb package is not installed.")
+        else:
+            sinks.append((name, SINKS[name]()))
+    return sinks
+
+def mirror(mode, table, data, **kwargs):
+    # mode is 'replace', 'merge' or 'append'; data may be a callable returning
+    # the data (called once per mirror), so large outputs are only re-read
+    # when a mirror is configured
+    for name, sink in local_sinks():
+        try:
+            getattr(sink, mode)(table, to_arrow(data() if callable(data) else data), **kwargs)
+            debug_message(f"{table} mirrored to {name} ({mode}).")
+        except Exception as e:
+            error_message(f"An error occurred while mirroring {table} to {name}: {str(e)}")
@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+
+import os
+import re
+import datetime
+import fsspec
+import pyarrow.parquet as pq
+from qb_common import debug_message, error_message, get_redshift_connection, S3_PREFIX
+from qb_load import split_table_name
+
+# Optional zero-load mode: instead of COPY into finance.*, the Parquet output is
+# written partitioned by realm and year and registered as a Spectrum external
+# table; the finance.* name becomes a late-binding view over it.
+# QB_SPECTRUM_TABLES lists the target tables that use this mode.
+SPECTRUM_SCHEMA = os.getenv("QB_SPECTRUM_SCHEMA", "qb_spectrum")
+SPECTRUM_DATABASE = os.getenv("QB_SPECTRUM_DATABASE", "qb_spectrum")
+SPECTRUM_PREFIX = f"{S3_PREFIX}/spectrum"
+PARTITION_COLUMNS = [("realm_id", "VARCHAR(32)"), ("txn_year", "INTEGER")]
+
+# Row groups small enough that per-row-group min/max statistics let Spectrum
+# skip most of a partition on a date filter
+ROWS_PER_ROW_GROUP = 50000
+
+RUN_SUFFIX = re.compile(r"\d{8}t\d{6}z")
+
+def spectrum_tables():
+    return [table.strip() for table in os.getenv("QB_SPECTRUM_TABLES", "").split(",") if table.strip()]
+
+def spectrum_enabled(table):
+    return table in spectrum_tables()
+
+def run_location(table, run_id):
+    # Every run writes under its own prefix; partitions are repointed once the
+    # run is complete, so readers never see a half-written year
+    _, name = split_table_name(table)
+    return f"{SPECTRUM_PREFIX}/{name}/run={run_id}"
+
+def new_run_id():
+    return datetime.datetime.now(datetime.timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+class PartitionedWriter:
+    # One open Parquet file per (realm_id, txn_year) partition
+
+    def __init__(self, location, schema):
+        self.location = location
+        self.schema = schema
+        self.files = {}
+        self.writers = {}
+        self.rows = 0
+
+    def partition_location(self, realm_id, txn_year):
+        return f"{self.location}/realm_id={realm_id}/txn_year={txn_year}"
+
+    def write(self, realm_id, txn_year, table):
+        key = (realm_id, txn_year)
+        if key not in self.writers:
+            self.files[key] = fsspec.open(f"{self.partition_location(realm_id, txn_year)}/part-00000.parquet", 'wb').open()
+            self.writers[key] = pq.ParquetWriter(self.files[key], self.schema, write_statistics=True)
+        self.writers[key].write_table(table, row_group_size=ROWS_PER_ROW_GROUP)
+        self.rows += table.num_rows
+
+    def close(self):
+        for key, writer in self.writers.items():
+            writer.close()
+            self.files[key].close()
+        return {key: self.partition_location(*key) for key in self.writers}
+
+def external_name(table, run_id):
+    # Each run gets its own external table; the view is repointed onto it
+    _, name = split_table_name(table)
+    return f"{SPECTRUM_SCHEMA}.{name}_{run_id.lower()}"
+
+def external_table_sql(external, spec, location):
+    columns = ",\n    ".join(f"{column} {redshift_type}" for column, redshift_type, _ in spec["columns"])
+    partitions = ", ".join(f"{column} {redshift_type}" for column, redshift_type in PARTITION_COLUMNS)
+    return (f"CREATE EXTERNAL TABLE {external} (\n    {columns}\n)"
+            f" PARTITIONED BY ({partitions}) STORED AS PARQUET LOCATION '{location}/';")
+
+def partition_sql(external, partitions):
+    clauses = [f"PARTITION (realm_id='{realm_id}', txn_year={txn_year}) LOCATION '{location}/'"
+               for (realm_id, txn_year), location in sorted(partitions.items())]
+    return f"ALTER TABLE {external} ADD IF NOT EXISTS " + " ".join(clauses) + ";"
+
+def register_external(table, spec, location, partitions, run_id):
+    # External DDL cannot run inside a transaction. Every run creates its own
+    # external table (so new columns and wider VARCHARs are picked up) and only
+    # then repoints the late-binding view, so readers always find a complete
+    # table; a failed CREATE leaves the view on the previous run. External
+    # tables of earlier runs are dropped once the view has moved. A regular
+    # table already holding the name is renamed aside, never dropped.
+    schema, name = split_table_name(table)
+    external = external_name(table, run_id)
+    conn = None
+    try:
+        debug_message(f"Registering {len(partitions)} partitions of {external} at {location}")
+        conn = get_redshift_connection()
+        conn.autocommit = True
+        cur = conn.cursor()
+        cur.execute(
+            f"CREATE EXTERNAL SCHEMA IF NOT EXISTS {SPECTRUM_SCHEMA} FROM DATA CATALOG DATABASE '{SPECTRUM_DATABASE}' "
+            f"IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' CREATE EXTERNAL DATABASE IF NOT EXISTS;")
+        cur.execute(f"DROP TABLE IF EXISTS {external};")
+        cur.execute(external_table_sql(external, spec, location))
+        if partitions:
+            cur.execute(partition_sql(external, partitions))
+
+        cur.execute("SELECT 1 FROM pg_tables WHERE schemaname = %s AND tablename = %s;", (schema, name))
+        if cur.fetchone():
+            debug_message(f"Renaming loaded table {table} to {name}_pre_spectrum before creating the view.")
+            cur.execute(f"ALTER TABLE {table} RENAME TO {name}_pre_spectrum;")
+        cur.execute(f"CREATE OR REPLACE VIEW {table} AS SELECT * FROM {external} WITH NO SCHEMA BINDING;")
+        debug_message(f"{table} now reads from {external}.")
+
+        cur.execute("SELECT tablename FROM svv_external_tables WHERE schemaname = %s AND tablename LIKE %s;",
+                    (SPECTRUM_SCHEMA, f"{name}\\_%"))
+        for (old,) in cur.fetchall():
+            # Only this table's run tables, named <name>_<run id>
+            if f"{SPECTRUM_SCHEMA}.{old}" != external and RUN_SUFFIX.fullmatch(old[len(name) + 1:]):
+                try:
+                    cur.execute(f"DROP TABLE IF EXISTS {SPECTRUM_SCHEMA}.{old};")
+                except Exception as e:
+                    error_message(f"Could not drop the old external table {SPECTRUM_SCHEMA}.{old}: {str(e)}")
+        cur.close()
+        return True
+    except Exception as e:
+        error_message(f"An error occurred while registering {table} in Spectrum: {str(e)}")
+        return False
+    finally:
+        if conn is not None:
+            conn.autocommit = False
+            conn.close()
+
+def remove_old_runs(table, run_id):
+    # Earlier runs are only removed once the new partitions are registered
+    _, name = split_table_name(table)
+    fs, path = fsspec.core.url_to_fs(f"{SPECTRUM_PREFIX}/{name}")
+    for old in fs.ls(path, detail=False):
+        if old.rstrip('/').rsplit('/', 1)[-1] != f"run={run_id}":
+            fs.rm(old, recursive=True)
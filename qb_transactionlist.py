@@ -5,6 +5,12 @@ import pandas as pd
 import json
 import os
 import psycopg2
+from qb_ddl import frame_spec
+from qb_s3 import write_parquet, swap_if_changed
+from qb_coordinator import submit_load
+from qb_ratelimit import limited_request
+from qb_report_stream import iter_report, column_titles
+from qb_columns import ColumnBuffers, STRING, FLOAT
 from datetime import datetime
 from dotenv import load_dotenv
 
@@ -56,29 +62,28 @@ params = {
     "end_date": datetime.now().strftime('%Y-%m-%d')
 }
 
-# Make the request to fetch report data
-response_report = requests.get(url_report, headers=headers_report, params=params)
+# Make the request to fetch report data; the body is streamed, not loaded whole
+response_report = limited_request(requests, "GET", url_report, realm_id, "report", headers=headers_report, params=params, stream=True)
 
 if response_report.status_code == 200:
     print(f"API request successful. Status code: {response_report.status_code}")
-    report_data = response_report.json()
 
-    # Extract the header information
-    header_info = report_data['Header']
-    start_period = header_info['StartPeriod']
-    end_period = header_info['EndPeriod']
-    
-    # Extract the columns
-    columns = [col['ColTitle'] for col in report_data['Columns']['Column']]
-    
-    # Extract the rows
-    rows = []
-    for row in report_data['Rows']['Row']:
-        row_data = [col.get('value', None) for col in row['ColData']]
-        rows.append(row_data)
+    # Extract the header information, the columns and the rows as they arrive
+    start_period = None
+    end_period = None
+    buffers = None
+    for section, value in iter_report(response_report):
+        if section == 'Header':
+            start_period = value['StartPeriod']
+            end_period = value['EndPeriod']
+        elif section == 'Columns':
+            # Rows are accumulated column by column: text is interned, amounts kept as doubles
+            buffers = ColumnBuffers([(title, FLOAT if title == 'Amount' else STRING) for title in column_titles(value)])
+        elif 'ColData' in value:
+            buffers.append([col.get('value', None) for col in value['ColData']])
     
     # Create DataFrame
-    df = pd.DataFrame(rows, columns=columns)
+    df = buffers.to_pandas()
     
     # Add header information as new columns to the DataFrame
     df['Start Period'] = start_period
@@ -88,6 +93,7 @@ if response_report.status_code == 200:
     print(df)
 else:
     print(f"Error: {response_report.status_code}, {response_report.text}")
+    raise SystemExit(1)
 
 # Convert non-numeric values in 'Amount' to NaN
 df['Amount'] = pd.to_numeric(df['Amount'], errors='coerce')
@@ -121,20 +127,12 @@ df.columns = transformed_columns
 def convert_column_to_numeric(df, column_name):
     df[column_name] = pd.to_numeric(df[column_name], errors='coerce')  # Convert to numeric, set invalid parsing as NaN
 
-# Apply data types
-df = df.astype({
-    'date': 'string',
-    'transaction_type': 'string',
-    'doc_num': 'string',
-    'is_no_post': 'string',
-    'name': 'string',
-    'description': 'string',
-    'account_name': 'string',
-    'split': 'string',
-    'amount': 'float64',
-    'start_period': 'string',
-    'end_period': 'string'
-})
+# Apply data types; text columns stay categorical, as built, through to the Parquet write
+df = df.astype({'amount': 'float64'})
+
+# Type dates here so the Parquet file matches the final table column for column
+for col in ['date', 'start_period', 'end_period']:
+    df[col] = pd.to_datetime(df[col], errors='coerce').dt.date
 
 # Check data types before saving to Parquet
 print("Data types after conversion:")
@@ -143,49 +141,13 @@ print(df.dtypes)
 # Save DataFrame to Parquet file
 s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_transactionlist.parquet'
 try:
-    df.to_parquet(s3_url, index=False, engine='pyarrow')
+    digest = write_parquet(df, s3_url)
     print(f"DataFrame successfully saved to Parquet file: {s3_url}")
 except Exception as e:
     print(f"An error occurred while saving DataFrame to Parquet file: {str(e)}")
+    raise SystemExit(1)
 
-# Define SQL statements
-sql_statements = [
-    """CREATE TABLE finance.temp_qb_transaction_list(
-          date               VARCHAR(255),
-          transaction_type   VARCHAR(50),
-          doc_num            VARCHAR(50),
-          is_no_post         VARCHAR(3),
-          name               VARCHAR(255),
-          description        VARCHAR(1024),
-          account_name       VARCHAR(255),
-          split              VARCHAR(255),
-          amount             DOUBLE PRECISION,
-          start_period       VARCHAR(255),
-          end_period         VARCHAR(255)
-       );""",
-    f"COPY finance.temp_qb_transaction_list FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-    "TRUNCATE TABLE finance.qb_transaction_list;",
-    """INSERT INTO finance.qb_transaction_list
-               SELECT 
-                    TO_DATE(date, 'YYYY-MM-DD') AS date,
-                    transaction_type,
-                    doc_num,
-                    is_no_post,
-                    name,
-                    description,
-                    account_name,
-                    split,
-                    amount,
-                    TO_DATE(start_period, 'YYYY-MM-DD') AS start_period,
-                    TO_DATE(end_period, 'YYYY-MM-DD') AS end_period
-               FROM finance.temp_qb_transaction_list;""",
-    """DROP TABLE finance.temp_qb_transaction_list;"""
-]
-
-for sql in sql_statements:
-    print(f"Executing SQL statement: {sql}")
-    execute_sql(sql)
-
-else:
-    print(f"Failed to retrieve data from API. Status code: {response_report.status_code}")
-    print(f"Response content: {response_report.text}")
+# Load with a single COPY and an atomic swap into finance.qb_transaction_list,
+# unless the file is exactly what the last successful run loaded
+submit_load('finance.qb_transaction_list', swap_if_changed, 'finance.qb_transaction_list', s3_url, digest,
+            frame_spec(df, sort_key=('date',)), df)
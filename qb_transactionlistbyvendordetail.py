@@ -1,204 +1,248 @@
 #!/usr/bin/env python
 
-import requests
-import pandas as pd
-import json
 import os
-import psycopg2
-from datetime import datetime
-from dotenv import load_dotenv
-
-def execute_sql(sql_query):
-    try:
-        print("Executing SQL query...")
-        conn = psycopg2.connect(
-            dbname=os.getenv("REDSHIFT_DB"),
-            user=os.getenv("REDSHIFT_USER"),
-            password=os.getenv("REDSHIFT_PASSWORD"),
-            host=os.getenv("REDSHIFT_HOST"),
-            port=os.getenv("REDSHIFT_PORT")
-        )
-        cur = conn.cursor()
-        cur.execute(sql_query)
-        conn.commit()
-        cur.close()
-        conn.close()
-        print("SQL query executed successfully.")
-    except Exception as e:
-        print(f"An error occurred while executing SQL query: {str(e)}")
-        print(f"SQL Query: {sql_query}")
-
-# Load environment variables
-load_dotenv("/home/sameen/qb_scripts/.env")
-load_dotenv("/home/sameen/qb_scripts/.env_access")
-
-# Get environment variables
-client_id = os.getenv("CLIENT_ID")
-client_secret = os.getenv("CLIENT_SECRET")
-refresh_token = os.getenv("REFRESH_TOKEN")
-realm_id = os.getenv("REALM_ID")
-access_token = os.getenv("CURR_AUTH_TOKEN")
-
-url_report = f"https://quickbooks.api.intuit.com/v3/company/{realm_id}/reports/TransactionListByVendor"
-
-# Ensure your access token is valid
-headers_report = {
-    "Authorization": f"Bearer {access_token}",
-    "Content-Type": "application/json",
-    "Accept": "application/json"
+import time
+import datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from qb_common import debug_message, error_message, load_credentials
+from qb_query import BASE_URL, get_session
+from qb_dimensions import refresh_dimensions, cached_records
+from qb_ddl import measure_widths, table_spec
+from qb_report_stream import iter_report, column_titles
+from qb_columns import ColumnBuffers, STRING, FLOAT, INT, DATE
+from qb_s3 import spool, publish, swap_if_changed
+from qb_coordinator import submit_load
+from qb_ratelimit import ApiSlot, retry_after
+from qb_spectrum import spectrum_enabled, PartitionedWriter, new_run_id, run_location, register_external, remove_old_runs
+
+# Reports have no paging, so the extract is sharded by vendor group x year
+# and the shards are fetched concurrently
+HISTORY_START = datetime.date(2015, 1, 1)
+VENDORS_PER_SHARD = int(os.getenv("QB_VENDORS_PER_SHARD", "25"))
+REPORT_WORKERS = int(os.getenv("QB_REPORT_WORKERS", "4"))
+SHARD_RETRIES = 3
+ROWS_PER_ROW_GROUP = 50000
+
+# Report column titles mapped to output columns
+COLUMN_TITLES = {
+    'Date': 'date',
+    'Transaction Type': 'transaction_type',
+    'Num': 'doc_num',
+    'Posting': 'posting',
+    'Memo/Description': 'description',
+    'Account': 'account',
+    'Amount': 'amount'
 }
 
-# Initialize pagination control variables
-has_more = True
-start_position = 1
-page_size = 100  # Number of records to fetch per page (change according to API limits)
-
-# Prepare a list to hold all transaction data across pages
-all_transaction_data = []
+# Output columns and how they are buffered; text and dates are interned per shard
+COLUMNS = [
+    ('vendor_id', INT),
+    ('vendor_name', STRING),
+    ('date', DATE),
+    ('transaction_type', STRING),
+    ('doc_num', STRING),
+    ('posting', STRING),
+    ('description', STRING),
+    ('account', STRING),
+    ('amount', FLOAT),
+    ('start_period', DATE),
+    ('end_period', DATE),
+    ('report_time', DATE)
+]
 
-while has_more:
-    # Define the query parameters, including start position and page size
+SCHEMA = ColumnBuffers(COLUMNS).schema()
+
+def build_shards(vendors, end_date):
+    vendor_ids = [vendor["Id"] for vendor in vendors]
+    windows = []
+    window_start = HISTORY_START
+    while window_start <= end_date:
+        window_end = min(datetime.date(window_start.year, 12, 31), end_date)
+        windows.append((window_start, window_end))
+        window_start = window_end + datetime.timedelta(days=1)
+    shards = []
+    for offset in range(0, len(vendor_ids), VENDORS_PER_SHARD):
+        for window_start, window_end in windows:
+            shards.append((vendor_ids[offset:offset + VENDORS_PER_SHARD], window_start, window_end))
+    return shards
+
+def parse_report(response_report, vendor_ids_by_name):
+    # Header and Columns precede Rows in the body, so both are known by the
+    # time the vendor sections stream past
+    start_period = end_period = report_time = None
+    positions = {}
+    buffers = ColumnBuffers(COLUMNS)
+    for section, value in iter_report(response_report):
+        if section == 'Header':
+            start_period = value.get('StartPeriod')
+            end_period = value.get('EndPeriod')
+            report_time = value.get('Time')
+            continue
+        if section == 'Columns':
+            # Locate the columns by title instead of trusting their position
+            titles = column_titles(value)
+            positions = {COLUMN_TITLES[title]: i for i, title in enumerate(titles) if title in COLUMN_TITLES}
+            continue
+        vendor_section = value
+        vendor_header = vendor_section.get('Header', {}).get('ColData', [{}])
+        vendor_name = vendor_header[0].get('value', '')
+        vendor_id = vendor_header[0].get('id') or vendor_ids_by_name.get(vendor_name)
+        for transaction in vendor_section.get('Rows', {}).get('Row', []):
+            col_data = transaction.get('ColData')
+            if not col_data:
+                continue
+            values = {name: col_data[i].get('value') if i < len(col_data) else None for name, i in positions.items()}
+            buffers.append([
+                vendor_id,
+                vendor_name,
+                values.get('date'),
+                values.get('transaction_type'),
+                values.get('doc_num'),
+                values.get('posting'),
+                values.get('description'),
+                values.get('account'),
+                values.get('amount'),
+                start_period,
+                end_period,
+                report_time
+            ])
+    return buffers.to_arrow()
+
+def fetch_shard(session, realm_id, shard, vendor_ids_by_name):
+    vendor_ids, window_start, window_end = shard
+    url_report = f"{BASE_URL}/{realm_id}/reports/TransactionListByVendor"
     params = {
-        "start_date": "2015-01-01",
-        "end_date": datetime.now().strftime('%Y-%m-%d'),
-        "start_position": start_position,  # Pagination parameter
-        "max_results": page_size,          # Limit the number of results per request
-        "columns": "Vendor ID, Vendor Name"
+        "start_date": window_start.strftime('%Y-%m-%d'),
+        "end_date": window_end.strftime('%Y-%m-%d'),
+        "vendor": ",".join(vendor_ids)
     }
-
-    # Make the request
-    response_report = requests.get(url_report, headers=headers_report, params=params)
-
-    if response_report.status_code == 200:
-        report_data = response_report.json()
-        print(f"Fetched page starting from position: {start_position}")
-        
-        # Extract header data
-        header = report_data.get('Header', {})
-        report_time = header.get('Time', '')
-        start_period = header.get('StartPeriod', '')
-        end_period = header.get('EndPeriod', '')
-
-        
-    # Extract transaction data from the JSON response
-    transactions = []
-
-    for vendor_section in report_data['Rows']['Row']:
-        vendor_name = vendor_section['Header']['ColData'][0]['value']
-        for transaction in vendor_section['Rows']['Row']:
-            transaction_data = {
-                'Vendor': vendor_name,
-                'Date': transaction['ColData'][0]['value'],
-                'Transaction Type': transaction['ColData'][1]['value'],
-                'Num': transaction['ColData'][2]['value'],
-                'Posting': transaction['ColData'][3]['value'],
-                'Memo/Description': transaction['ColData'][4]['value'],
-                'Account': transaction['ColData'][5]['value'],
-                'Amount': transaction['ColData'][6]['value']
-            }
-            transactions.append(transaction_data)
-
-    # Create a DataFrame from the extracted transaction data
-    df = pd.DataFrame(transactions)
-                            # Append the extracted data to the list
-                            rows.append({
-                                'Vendor': vendor_name,
-                                'Date': date,
-                                'transaction_type': txn_type,
-                                'doc_num': doc_num,
-                                'posting': is_posting,
-                                'description': memo,
-                                'account': account_name,
-                                'amount': amount,
-                                'start_period': start_period,
-                                'end_period': end_period,
-                                'report_time': report_time
-                            })
-        
-        # Append the data from the current page to the overall transaction data
-        all_transaction_data.extend(rows)
-    
-        # Check if there is more data to fetch
-        has_more = report_data.get('hasMore', False)  # Use 'hasMore' if provided by API
-        start_position += page_size  # Move to the next set of results
-
-    else:
-        print(f"Failed to retrieve data from API. Status code: {response_report.status_code}")
-        print(f"Response content: {response_report.text}")
-        has_more = False  # Stop if there is an error
-
-# After fetching all pages, create DataFrame
-df = pd.DataFrame(all_transaction_data)
-
-# Replace empty strings with NaN in the amount column
-df['amount'].replace('', pd.NA, inplace=True)
-
-# Convert 'amount' column to numeric, setting invalid parsing as NaN
-df['amount'] = pd.to_numeric(df['amount'], errors='coerce')
-
-print(df)
- # Apply data types
-df = df.astype({
-    'vendor_id' : 'int32',
-    'vendor_name' : 'string',
-    'date': 'string',
-    'transaction_type': 'string',
-    'doc_num': 'string',
-    'posting': 'string',
-    'description': 'string',
-    'account': 'string',
-    'amount': 'float64',
-    'start_period': 'string',
-    'end_period': 'string',
-    'report_time': 'string'
-})
-
-print(df.dtypes)
-
-# Save DataFrame to Parquet file
-s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_transactionlistbyvendor.parquet'
-try:
-    df.to_parquet(s3_url, index=False, engine='pyarrow')
-    print(f"DataFrame successfully saved to Parquet file: {s3_url}")
-except Exception as e:
-    print(f"An error occurred while saving DataFrame to Parquet file: {str(e)}")
-
-# SQL statements to load data into Redshift
-sql_statements = [
-    """CREATE TABLE IF NOT EXISTS finance.temp_qb_transactionlist_by_vendor(
-          vendor_id INT,
-          vendor_name VARCHAR(1024),
-          date VARCHAR(10),
-          transaction_type VARCHAR(50),
-          doc_num VARCHAR(50),
-          posting VARCHAR(10),
-          description VARCHAR(625),
-          account VARCHAR(100),
-          amount DOUBLE PRECISION,
-          start_period VARCHAR(10),
-          end_period VARCHAR(10),
-          report_time VARCHAR(25)
-       );""",
-    f"COPY finance.temp_qb_transactionlist_by_vendor FROM '{s3_url}' IAM_ROLE '{os.getenv('REDSHIFT_IAM_ROLE')}' FORMAT AS PARQUET;",
-    "TRUNCATE TABLE finance.qb_transactionlist_by_vendor;",
-    """INSERT INTO finance.qb_transactionlist_by_vendor
-               SELECT 
-                   vendor_id,
-                   vendor_name,
-                   TO_DATE(date, 'YYYY-MM-DD') AS date,
-                   transaction_type,
-                   doc_num,
-                   posting,
-                   description,
-                   account,
-                   amount,
-                   TO_DATE(start_period, 'YYYY-MM-DD') AS start_period,
-                   TO_DATE(end_period, 'YYYY-MM-DD') AS end_period,
-                   TO_DATE(report_time, 'YYYY-MM-DD') AS report_time
-               FROM finance.temp_qb_transactionlist_by_vendor;""",
-    """DROP TABLE IF EXISTS finance.temp_qb_transactionlist_by_vendor;"""
-]
-
-for sql in sql_statements:
-    print(f"Executing SQL statement: {sql}")
-    execute_sql(sql)
+    for attempt in range(1, SHARD_RETRIES + 1):
+        # The shared limiter slot is held while the body streams in
+        with ApiSlot(realm_id, "report") as slot:
+            response_report = session.get(url_report, params=params, stream=True)
+            slot.record(response_report.status_code)
+            if response_report.status_code == 200:
+                return parse_report(response_report, vendor_ids_by_name)
+        if response_report.status_code != 429 and response_report.status_code < 500:
+            break
+        time.sleep(retry_after(response_report, attempt))
+    raise RuntimeError(f"Shard {params} failed with status code {response_report.status_code}: {response_report.text}")
+
+def fetch_shard_tables(session, realm_id, shards, vendor_ids_by_name):
+    # Yields (shard, table) in shard order (vendor group x year), so the same
+    # report always serializes to the same bytes and unchanged output is
+    # recognised by its digest. A few shards are fetched ahead of the one
+    # being yielded to keep every worker busy.
+    ahead = REPORT_WORKERS * 2
+    with ThreadPoolExecutor(max_workers=REPORT_WORKERS) as executor:
+        pending = deque()
+        for completed, shard in enumerate(shards, start=1):
+            pending.append((shard, executor.submit(fetch_shard, session, realm_id, shard, vendor_ids_by_name)))
+            if len(pending) > ahead:
+                done_shard, future = pending.popleft()
+                yield done_shard, future.result()
+            if completed % 50 == 0:
+                debug_message(f"{completed}/{len(shards)} shards requested.")
+        while pending:
+            done_shard, future = pending.popleft()
+            yield done_shard, future.result()
+
+def extract_to_parquet(session, realm_id, shards, vendor_ids_by_name, sink):
+    # Shards are written out in shard order as they arrive, so the full report never sits in
+    # memory as rows; VARCHAR widths are measured on the way through for the DDL
+    total_rows = 0
+    widths = {}
+    buffered = []
+    buffered_rows = 0
+    with pq.ParquetWriter(sink, SCHEMA) as writer:
+        for shard, shard_table in fetch_shard_tables(session, realm_id, shards, vendor_ids_by_name):
+            buffered.append(shard_table)
+            buffered_rows += shard_table.num_rows
+            if buffered_rows >= ROWS_PER_ROW_GROUP:
+                batch = pa.concat_tables(buffered)
+                writer.write_table(batch)
+                widths = measure_widths(batch, widths)
+                total_rows += buffered_rows
+                buffered = []
+                buffered_rows = 0
+        if buffered:
+            batch = pa.concat_tables(buffered)
+            writer.write_table(batch)
+            widths = measure_widths(batch, widths)
+            total_rows += buffered_rows
+    return total_rows, widths
+
+def spooled_batches(sink):
+    sink.seek(0)
+    parquet_file = pq.ParquetFile(sink)
+    return pa.RecordBatchReader.from_batches(parquet_file.schema_arrow, parquet_file.iter_batches())
+
+def extract_to_spectrum(session, realm_id, shards, vendor_ids_by_name, location):
+    # Every shard covers a single calendar year, so shards go straight to their
+    # year's partition, buffered per year into full row groups sorted by date
+    writer = PartitionedWriter(location, SCHEMA)
+    widths = {}
+    buffered = {}
+
+    def flush(year):
+        batch = pa.concat_tables(buffered.pop(year)).sort_by('date')
+        writer.write(realm_id, year, batch)
+        return measure_widths(batch, widths)
+
+    for shard, shard_table in fetch_shard_tables(session, realm_id, shards, vendor_ids_by_name):
+        year = shard[1].year
+        buffered.setdefault(year, []).append(shard_table)
+        if sum(table.num_rows for table in buffered[year]) >= ROWS_PER_ROW_GROUP:
+            widths = flush(year)
+    for year in list(buffered):
+        widths = flush(year)
+    partitions = writer.close()
+    return writer.rows, widths, partitions
+
+if __name__ == "__main__":
+    try:
+        debug_message("Script started.")
+        credentials = load_credentials()
+        if credentials is None:
+            raise SystemExit(1)
+        realm_id = credentials["realm_id"]
+        session = get_session(credentials)
+
+        # The vendor list comes from the shared dimension cache, refreshed incrementally
+        refresh_dimensions(session, realm_id, ["Vendor"])
+        vendors = cached_records("Vendor")
+        vendor_ids_by_name = {vendor.get("DisplayName"): vendor["Id"] for vendor in vendors}
+        shards = build_shards(vendors, datetime.date.today())
+        debug_message(f"Fetching TransactionListByVendor for {len(vendors)} vendors in {len(shards)} shards.")
+
+        table = 'finance.qb_transactionlist_by_vendor'
+        if spectrum_enabled(table):
+            # History stays in S3 and is queried through Spectrum; nothing is loaded
+            run_id = new_run_id()
+            location = run_location(table, run_id)
+            total_rows, widths, partitions = extract_to_spectrum(session, realm_id, shards, vendor_ids_by_name, location)
+            debug_message(f"{total_rows} rows saved to {len(partitions)} partitions under {location}")
+            if register_external(table, table_spec(SCHEMA, widths), location, partitions, run_id):
+                remove_old_runs(table, run_id)
+        else:
+            s3_url = 's3://datalake-medusadistribution/datalake/to_redshift/qb/qb_transactionlistbyvendor.parquet'
+            sink = spool()
+            total_rows, widths = extract_to_parquet(session, realm_id, shards, vendor_ids_by_name, sink)
+            digest = publish(sink, s3_url)
+            debug_message(f"{total_rows} rows saved to Parquet file: {s3_url}")
+
+            def load_report():
+                # Load with a single COPY and an atomic swap into finance.qb_transactionlist_by_vendor,
+                # unless the file is exactly what the last successful run loaded; the mirrors
+                # stream the same spooled file back batch by batch
+                try:
+                    return swap_if_changed(table, s3_url, digest, table_spec(SCHEMA, widths, sort_key=('date',), dist_key='vendor_id'),
+                                           lambda: spooled_batches(sink))
+                finally:
+                    sink.close()
+            submit_load(table, load_report)
+    except Exception as e:
+        error_message(f"An unexpected error occurred: {str(e)}")
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+
+import numpy as np
+import pandas as pd
+from qb_common import debug_message, error_message
+
+# Pre-load checks run on the transformed frame, before anything is written to
+# S3 or Redshift. Each check returns a list of problems; gate() raises when
+# there are any, so a bad extract never replaces production data and the
+# change index is not advanced.
+AMOUNT_TOLERANCE = 0.005
+SAMPLE_SIZE = 10
+
+class ValidationError(Exception):
+    pass
+
+def sample(values):
+    values = list(values)
+    shown = ", ".join(str(value) for value in values[:SAMPLE_SIZE])
+    return shown + (f" (+{len(values) - SAMPLE_SIZE} more)" if len(values) > SAMPLE_SIZE else "")
+
+def check_row_count(entity, records, expected):
+    # Rows created after the COUNT(*) probe may push the extract above the
+    # probe; anything below it means pages were lost. records may be the
+    # fetched records or just their number, when they were streamed
+    fetched = records if isinstance(records, int) else len(records)
+    if expected is not None and fetched < expected:
+        return [f"{entity}: fetched {fetched} records but COUNT(*) reported {expected}"]
+    return []
+
+def check_duplicate_keys(df, keys=('id', 'line_id')):
+    duplicated = df.duplicated(subset=list(keys), keep=False)
+    if not duplicated.any():
+        return []
+    dupes = df.loc[duplicated, list(keys)].drop_duplicates()
+    return [f"{len(dupes)} duplicate ({', '.join(keys)}) keys: {sample(map(tuple, dupes.itertuples(index=False)))}"]
+
+def check_balanced_entries(df, key='id', posting_column='line_posting_type', amount_column='line_amount'):
+    # Debits and credits of every journal entry have to net to zero
+    amount = pd.to_numeric(df[amount_column], errors='coerce').fillna(0).to_numpy(dtype='float64')
+    posting = df[posting_column].astype('string').str.lower().to_numpy(na_value='')
+    signed = np.where(posting == 'debit', amount, np.where(posting == 'credit', -amount, 0.0))
+    net = pd.Series(signed, index=df.index).groupby(df[key]).sum()
+    unbalanced = net[net.abs() > AMOUNT_TOLERANCE]
+    if unbalanced.empty:
+        return []
+    return [f"{len(unbalanced)} entries where debits != credits: {sample(unbalanced.index)}"]
+
+def check_line_totals(df, key='id', total_column='total_amt', amount_column='line_amount'):
+    # The header total has to equal the sum of its lines; a dropped Line shows up here
+    grouped = df.groupby(key)
+    line_sum = pd.to_numeric(df[amount_column], errors='coerce').fillna(0).groupby(df[key]).sum()
+    total = pd.to_numeric(grouped[total_column].first(), errors='coerce').fillna(0)
+    mismatched = line_sum[(line_sum - total).abs() > AMOUNT_TOLERANCE]
+    if mismatched.empty:
+        return []
+    return [f"{len(mismatched)} transactions where line amounts != {total_column}: {sample(mismatched.index)}"]
+
+def gate(name, *checks):
+    problems = [problem for check in checks for problem in check]
+    if problems:
+        for problem in problems:
+            error_message(f"Validation failed for {name}: {problem}")
+        raise ValidationError(f"{name} blocked from loading: {len(problems)} validation problem(s)")
+    debug_message(f"Validation passed for {name}.")
@@ -0,0 +1,40 @@
+import re
+import qb_bills
+from qb_ddl import frame_spec, create_table_sql
+
+BILL = {
+    "Id": "145",
+    "SyncToken": "2",
+    "DocNumber": "INV-7",
+    "TxnDate": "2024-03-04",
+    "DueDate": "2024-04-03",
+    "Balance": 120.5,
+    "PrivateNote": "April stock",
+    "VendorRef": {"value": "56", "name": "Acme Supply"},
+    "APAccountRef": {"value": "33", "name": "Accounts Payable (A/P)"},
+    "Line": [{"Id": "1", "Amount": 120.5, "DetailType": "AccountBasedExpenseLineDetail",
+              "AccountBasedExpenseLineDetail": {"AccountRef": {"value": "7", "name": "Inventory"}}}]
+}
+
+def test_bill_columns_match_the_table(monkeypatch):
+    monkeypatch.delenv("QB_ID_ONLY_FACTS", raising=False)
+    df = qb_bills.build_frame([BILL])
+    assert ["vendor_ref_value", "vendor_ref_name", "ap_account_ref_value", "ap_account_ref_name"] == \
+        [col for col in df.columns if col.endswith(("_value", "_name"))]
+    assert df.loc[0, "ap_account_ref_name"] == "Accounts Payable (A/P)"
+
+def test_bill_ddl_is_valid(monkeypatch):
+    monkeypatch.delenv("QB_ID_ONLY_FACTS", raising=False)
+    df = qb_bills.build_frame([BILL])
+    statement = create_table_sql("finance.qb_bills", frame_spec(df, sort_key=("txn_date",), dist_key="id"))
+    columns = re.search(r"\((.*)\) DISTSTYLE", statement, re.S).group(1).split(",\n")
+    names = [column.split()[0] for column in columns]
+    assert names == list(df.columns)
+    assert all(re.fullmatch(r"[a-z_][a-z0-9_]*", name) for name in names)
+
+def test_id_only_facts_empties_bill_names(monkeypatch):
+    monkeypatch.setenv("QB_ID_ONLY_FACTS", "true")
+    df = qb_bills.build_frame([BILL])
+    assert df["vendor_ref_name"].isna().all()
+    assert df["ap_account_ref_name"].isna().all()
+    assert df.loc[0, "vendor_ref_value"] == "56"